@@ -25,6 +25,7 @@ elif os.name == 'posix':  # Linux
 datas += [
     ('llama_assistant/resources/*.onnx', 'llama_assistant/resources'),
     ('llama_assistant/resources/*.png', 'llama_assistant/resources'),
+    ('llama_assistant/resources/*.json', 'llama_assistant/resources'),
 ]
 
 a = Analysis(
@@ -32,7 +33,10 @@ a = Analysis(
     pathex=['llama_assistant'],
     binaries=[],
     datas=datas,
-    hiddenimports=["ffmpeg"],
+    hiddenimports=["ffmpeg", "llama_assistant.bench", "llama_assistant.autotune",
+                   "llama_assistant.daemon", "llama_assistant.ask",
+                   "llama_assistant.server", "llama_assistant.conversation_store",
+                   "llama_assistant.batch_images", "llama_assistant.download_manager"],
     hookspath=[],
     runtime_hooks=[],
     excludes=[],
@@ -0,0 +1,50 @@
+import argparse
+import sys
+
+from llama_assistant import config
+from llama_assistant.inference_worker import InferenceWorker
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="llama-assistant ask",
+        description="Ask the daemon, or a worker of its own if none is running, from the shell",
+    )
+    parser.add_argument("message", nargs="+")
+    parser.add_argument("--model", help="Model ID (default: the configured text model)")
+    parser.add_argument("--task", choices=list(config.TASK_PROMPTS), default="chat")
+    args = parser.parse_args(argv)
+
+    settings = config.load_settings()
+    model_id = args.model or settings["text_model"]
+    prompt, prefix = config.get_task_prompt(args.task, " ".join(args.message))
+
+    worker = InferenceWorker()
+    worker.start()
+    if not worker.is_attached_to_daemon():
+        print("No daemon is running, loading the model in this process", file=sys.stderr)
+    worker.send("settings", settings)
+    worker.send("generate", 1, model_id, {"prompt": prompt, "prefix": prefix, "task": args.task})
+
+    exit_code = 0
+    try:
+        while True:
+            event = worker.poll(0.01)
+            for _, text in worker.read_tokens():
+                print(text, end="", flush=True)
+            if event is None:
+                if not worker.is_alive():
+                    print("\nThe inference worker stopped unexpectedly", file=sys.stderr)
+                    exit_code = 1
+                    break
+            elif event[0] == "error":
+                print(f"\n{event[1]}", file=sys.stderr)
+                exit_code = 1
+            elif event[0] == "finished":
+                break
+    except KeyboardInterrupt:
+        exit_code = 130
+    finally:
+        worker.close()
+    print()
+    return exit_code
@@ -0,0 +1,144 @@
+import argparse
+import json
+import platform
+import time
+from typing import Dict, List
+
+from llama_assistant import config, hardware
+from llama_assistant.bench import run_prompt
+from llama_assistant.utils import get_resource_path
+
+
+def get_calibration_prompt() -> str:
+    # Long enough to span several batches, so that n_batch makes a difference
+    with open(get_resource_path("llama_assistant/resources/bench_corpus.json")) as f:
+        texts = json.load(f)["texts"]
+    prompt, _ = config.get_task_prompt("Summarize", "\n\n".join(texts))
+    return prompt
+
+
+def get_profile_key(model_file_key: str) -> str:
+    return f"{model_file_key}@{platform.node()}"
+
+
+def load_tuned_profiles() -> Dict:
+    if not config.autotune_file.exists():
+        return {}
+    with open(config.autotune_file, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+
+def get_tuned_profile(model_file_key: str) -> Dict:
+    """Autotuned runtime options of a model file on this host, empty if not tuned"""
+    tuned = load_tuned_profiles().get(get_profile_key(model_file_key), {})
+    return {key: tuned[key] for key in ("n_threads", "n_threads_batch", "n_batch") if key in tuned}
+
+
+def save_tuned_profile(model_file_key: str, profile: Dict):
+    profiles = load_tuned_profiles()
+    profiles[get_profile_key(model_file_key)] = profile
+    with open(config.autotune_file, "w") as f:
+        json.dump(profiles, f, indent=2)
+
+
+def set_threads(model, n_threads: int, n_threads_batch: int):
+    import llama_cpp
+
+    llama_cpp.llama_set_n_threads(model.ctx, n_threads, n_threads_batch)
+    model.n_threads = n_threads
+    model.n_threads_batch = n_threads_batch
+    model.context_params.n_threads = n_threads
+    model.context_params.n_threads_batch = n_threads_batch
+
+
+def measure(model, prompt: str, runs: int, max_tokens: int) -> Dict:
+    results = [run_prompt(model, prompt, max_tokens) for _ in range(runs)]
+    return {
+        "prompt_eval_tps": max(r["prompt_eval_tps"] or 0 for r in results),
+        "generation_tps": max(r["generation_tps"] or 0 for r in results),
+    }
+
+
+def thread_candidates() -> List[int]:
+    physical = hardware.physical_core_count()
+    logical = hardware.logical_core_count()
+    candidates = {1, max(physical // 2, 1), max(physical - 1, 1), physical, logical}
+    return sorted(candidates)
+
+
+def autotune(model_id: str, threads: List[int], batches: List[int], runs: int, max_tokens: int):
+    from llama_assistant.model_handler import handler as model_handler
+
+    model = model_handler.get_model(model_id)
+    if model is None:
+        print(f"Model with ID {model_id} not found.")
+        return None
+
+    prompt = get_calibration_prompt()
+    best = None
+    for n_batch in batches:
+        model_data = model_handler.load_model(model_id, runtime={"n_batch": n_batch})
+        if not model_data:
+            return None
+        llm = model_data["model"]
+
+        # n_threads only affects generation and n_threads_batch only affects prompt
+        # evaluation, so they are tuned one after the other
+        generation = {}
+        for n_threads in threads:
+            set_threads(llm, n_threads, max(threads))
+            generation[n_threads] = measure(llm, prompt, runs, max_tokens)["generation_tps"]
+            print(f"n_batch={n_batch} n_threads={n_threads}: {generation[n_threads]:.1f} tok/s")
+        n_threads = max(generation, key=generation.get)
+
+        prompt_eval = {}
+        for n_threads_batch in threads:
+            set_threads(llm, n_threads, n_threads_batch)
+            prompt_eval[n_threads_batch] = measure(llm, prompt, runs, 1)["prompt_eval_tps"]
+            print(
+                f"n_batch={n_batch} n_threads_batch={n_threads_batch}: "
+                f"{prompt_eval[n_threads_batch]:.1f} prompt tok/s"
+            )
+        n_threads_batch = max(prompt_eval, key=prompt_eval.get)
+
+        result = {
+            "n_threads": n_threads,
+            "n_threads_batch": n_threads_batch,
+            "n_batch": n_batch,
+            "generation_tps": generation[n_threads],
+            "prompt_eval_tps": prompt_eval[n_threads_batch],
+        }
+        if best is None or result["prompt_eval_tps"] > best["prompt_eval_tps"]:
+            best = result
+
+    # Reload with the tuned settings on the next use
+    model_handler.unload_model(model_id)
+    best["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    save_tuned_profile(model.get_file_key(), best)
+    return best
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="llama-assistant autotune",
+        description="Find the fastest n_threads, n_threads_batch and n_batch for a model",
+    )
+    parser.add_argument("model_id", nargs="?", help="Model ID (default: the configured text model)")
+    parser.add_argument("--threads", type=int, nargs="+", default=thread_candidates())
+    parser.add_argument("--batches", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--runs", type=int, default=2, help="Runs per configuration")
+    parser.add_argument("--max-tokens", type=int, default=32)
+    args = parser.parse_args(argv)
+
+    if args.model_id is None:
+        args.model_id = config.load_settings()["text_model"]
+
+    best = autotune(args.model_id, args.threads, args.batches, args.runs, args.max_tokens)
+    if best is None:
+        return 1
+    print(f"Best settings for {args.model_id} on {platform.node()}: {best}")
+    print(f"Saved to {config.autotune_file}")
+    return 0
@@ -0,0 +1,142 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Set, Tuple
+
+from llama_assistant import config
+from llama_assistant.image_preprocessor import image_to_data_uri
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp", ".tif", ".tiff"}
+
+
+def find_images(paths: List[Path], recursive: bool) -> List[Path]:
+    images = []
+    for path in paths:
+        if path.is_dir():
+            files = path.rglob("*") if recursive else path.iterdir()
+            images.extend(f for f in files if f.suffix.lower() in IMAGE_EXTENSIONS)
+        elif path.exists():
+            images.append(path)
+        else:
+            print(f"Skipping {path}: no such file or directory")
+    return sorted(set(images))
+
+
+def read_done_paths(output: Path) -> Set[str]:
+    """Images that already have a response in the results of an earlier run"""
+    done = set()
+    if not output.exists():
+        return done
+    with open(output, "r") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Partially written last line of an interrupted run
+            if "response" in result:
+                done.add(result["path"])
+    return done
+
+
+def prepare_image(path: str, model_id: str) -> Tuple[str, str]:
+    """Decode and scale an image in a pool process, returns the data URI or the error"""
+    try:
+        return image_to_data_uri(path, model_id), ""
+    except Exception as e:
+        return "", str(e)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="llama-assistant batch-images",
+        description="Run one prompt over many images with the multimodal model",
+    )
+    parser.add_argument("paths", nargs="+", type=Path, help="Image files or directories")
+    parser.add_argument("--prompt", required=True)
+    parser.add_argument("--output", type=Path, default=Path("results.jsonl"))
+    parser.add_argument("--model", help="Model ID (default: the configured multimodal model)")
+    parser.add_argument("--recursive", action="store_true", help="Look into subdirectories")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=max(1, (os.cpu_count() or 2) // 2),
+        help="Processes that decode and scale the images",
+    )
+    args = parser.parse_args(argv)
+
+    settings = config.load_settings()
+    model_id = args.model or settings["multimodal_model"]
+    images = [str(path.resolve()) for path in find_images(args.paths, args.recursive)]
+    done = read_done_paths(args.output)
+    todo = [path for path in images if path not in done]
+    print(f"{len(images)} images, {len(images) - len(todo)} already done, {len(todo)} to go")
+    if not todo:
+        return 0
+
+    # Imported here so that the pool processes do not load llama.cpp
+    from llama_assistant.model_handler import handler as model_handler
+
+    model_handler.apply_settings(settings)
+    if not model_handler.warm_up(model_id):
+        print(f"Failed to load model: {model_id}")
+        return 1
+
+    # The pool decodes the next images while the model answers about the current one
+    context = multiprocessing.get_context("spawn")
+    n_processed = 0
+    n_failed = 0
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(args.workers, mp_context=context) as pool, open(
+        args.output, "a"
+    ) as output:
+        pending = deque()
+        remaining = iter(todo)
+        try:
+            for path in remaining:
+                pending.append((path, pool.submit(prepare_image, path, model_id)))
+                if len(pending) < 2 * args.workers:
+                    continue
+                n_failed += process_next(pending, model_handler, model_id, args.prompt, output)
+                n_processed += 1
+            while pending:
+                n_failed += process_next(pending, model_handler, model_id, args.prompt, output)
+                n_processed += 1
+        except KeyboardInterrupt:
+            print("\nInterrupted, run the same command again to continue")
+            for _, future in pending:
+                future.cancel()
+        finally:
+            elapsed = time.perf_counter() - start_time
+            rate = n_processed / elapsed * 60 if elapsed > 0 else 0.0
+            print(
+                f"{n_processed} images ({n_failed} failed) in {elapsed:.1f}s, "
+                f"{rate:.1f} images/min, results in {args.output}"
+            )
+    return 0
+
+
+def process_next(pending: deque, model_handler, model_id: str, prompt: str, output) -> int:
+    """Answer the prompt about the oldest pending image, returns 1 if it failed"""
+    path, future = pending.popleft()
+    image, error = future.result()
+    start_time = time.perf_counter()
+    result = {"path": path, "prompt": prompt, "model": model_id}
+    if not error:
+        try:
+            response = model_handler.chat_completion(model_id, prompt, image=image, task="image")
+            result["response"] = response["choices"][0]["message"]["content"]
+        except Exception as e:
+            error = str(e)
+    if error:
+        result["error"] = error
+    result["seconds"] = round(time.perf_counter() - start_time, 3)
+    # One line per image as soon as it is done, so an interrupted run can resume
+    output.write(json.dumps(result) + "\n")
+    output.flush()
+    print(f"{path}: {error or ' '.join(result['response'].split())[:100]}")
+    return 1 if error else 0
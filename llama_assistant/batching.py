@@ -0,0 +1,328 @@
+import codecs
+import ctypes
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Dict, List, Optional
+
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+
+# Sampling options the engine implements, other options need Llama.create_chat_completion
+BATCHING_PARAMS = {"max_tokens", "temperature", "top_p", "top_k", "min_p", "seed", "stop"}
+
+
+class Sequence:
+    """One request in the engine: its prompt, KV slot, sampler and output stream"""
+
+    def __init__(self, tokens: List[int], max_tokens: int, stop: List[str], sampler):
+        self.id = f"chatcmpl-{uuid.uuid4().hex}"
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.stop = stop
+        self.sampler = sampler
+        self.slot: Optional[int] = None
+        self.n_past = 0  # Tokens of this sequence in the KV cache
+        self.next_token: Optional[int] = None  # Sampled, not evaluated yet
+        self.n_generated = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.text = ""  # Generated text that is not emitted yet, held back for stop strings
+        self.output: "queue.Queue" = queue.Queue()
+        self.cancelled = threading.Event()
+        self.created = int(time.time())
+
+
+class CompletionStream:
+    """Iterator over the chunks of one sequence, like a create_chat_completion stream"""
+
+    def __init__(self, sequence: Sequence):
+        self.sequence = sequence
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Dict:
+        chunk = self.sequence.output.get()
+        if chunk is None:
+            raise StopIteration
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+    def close(self):
+        # The engine frees the slot at the next step
+        self.sequence.cancelled.set()
+
+    def __del__(self):
+        # A stream dropped before the end must not keep decoding into its slot
+        self.close()
+
+
+class BatchingEngine:
+    """Continuous batching of several chat completions in one llama.cpp context.
+
+    Every active sequence owns a KV cache slot (a llama.cpp sequence ID). Each step
+    builds one batch with the next token of every generating sequence plus as many
+    prompt tokens of newly admitted sequences as fit, and evaluates it with a single
+    llama_decode call. Requests join and leave between steps, so a long generation
+    does not hold up the others and the matrix multiplications stay large enough to
+    use all cores.
+
+    The engine creates its own context from the loaded model's weights, so it does
+    not touch the KV cache that Llama.create_chat_completion uses.
+    """
+
+    def __init__(self, llm: Llama, n_slots: int = 4, n_batch: int = 512):
+        self.llm = llm
+        self.n_slots = n_slots
+        self.n_batch = n_batch
+        # Each sequence gets as many positions as the model's own context
+        self.slot_ctx = llm.n_ctx()
+
+        params = type(llm.context_params).from_buffer_copy(llm.context_params)
+        params.n_ctx = self.slot_ctx * n_slots
+        params.n_batch = n_batch
+        params.n_ubatch = min(params.n_ubatch, n_batch)
+        params.n_seq_max = n_slots
+        self.ctx = llama_cpp.llama_new_context_with_model(llm.model, params)
+        if not self.ctx:
+            raise RuntimeError("Failed to create the batching context")
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+
+        self.formatter = self._create_formatter()
+        self.pending: "deque[Sequence]" = deque()
+        self.active: List[Sequence] = []
+        self.free_slots = list(range(n_slots))
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = True
+        self.stats = {"requests": 0, "generated_tokens": 0, "decode_time": 0.0, "max_active": 0}
+        self.thread = threading.Thread(target=self._run, name="batching-engine", daemon=True)
+        self.thread.start()
+
+    def _create_formatter(self) -> Optional[Jinja2ChatFormatter]:
+        template = (self.llm.metadata or {}).get("tokenizer.chat_template")
+        if not template:
+            return None
+        return Jinja2ChatFormatter(
+            template=template,
+            eos_token=self._token_text(self.llm.token_eos()),
+            bos_token=self._token_text(self.llm.token_bos()),
+        )
+
+    def _token_text(self, token: int) -> str:
+        if token == -1:
+            return ""
+        return self.llm.detokenize([token], special=True).decode("utf-8", errors="ignore")
+
+    def format_prompt(self, messages: List[Dict]) -> str:
+        if self.formatter is not None:
+            return self.formatter(messages=messages).prompt
+        lines = [f"{m['role']}: {m['content']}" for m in messages]
+        return "\n".join(lines) + "\nassistant: "
+
+    def create_chat_completion(
+        self,
+        messages: List[Dict],
+        max_tokens: Optional[int] = None,
+        temperature: float = 0.2,
+        top_p: float = 0.95,
+        top_k: int = 40,
+        min_p: float = 0.05,
+        seed: Optional[int] = None,
+        stop=None,
+    ) -> CompletionStream:
+        """Queue a chat completion and return the stream of its chunks"""
+        prompt = self.format_prompt(messages)
+        tokens = self.llm.tokenize(prompt.encode("utf-8"), add_bos=False, special=True)
+        if len(tokens) >= self.slot_ctx:
+            raise ValueError(
+                f"Prompt of {len(tokens)} tokens does not fit in the context of {self.slot_ctx}"
+            )
+        room = self.slot_ctx - len(tokens)
+        max_tokens = min(max_tokens, room) if max_tokens else room
+        stop = [stop] if isinstance(stop, str) else list(stop or [])
+
+        sampler = self._create_sampler(temperature, top_p, top_k, min_p, seed)
+        sequence = Sequence(tokens, max_tokens, stop, sampler)
+        with self.lock:
+            self.pending.append(sequence)
+            self.stats["requests"] += 1
+        self.wakeup.set()
+        return CompletionStream(sequence)
+
+    def _create_sampler(self, temperature, top_p, top_k, min_p, seed):
+        sampler = llama_cpp.llama_sampler_chain_init(llama_cpp.llama_sampler_chain_default_params())
+        if temperature <= 0:
+            llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_greedy())
+            return sampler
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_top_k(top_k))
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_top_p(top_p, 1))
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_min_p(min_p, 1))
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_temp(temperature))
+        seed = llama_cpp.LLAMA_DEFAULT_SEED if seed is None else seed
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_dist(seed))
+        return sampler
+
+    def get_stats(self) -> Dict:
+        decode_time = self.stats["decode_time"]
+        return {
+            **self.stats,
+            "active": len(self.active),
+            "pending": len(self.pending),
+            "tokens_per_second": (
+                self.stats["generated_tokens"] / decode_time if decode_time else None
+            ),
+        }
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        for sequence in list(self.pending) + self.active:
+            self._finish(sequence, None)
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
+
+    def _run(self):
+        while self.running:
+            self._admit()
+            if not self.active:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            try:
+                self._step()
+            except Exception as e:
+                print(f"Batching engine step failed: {e}")
+                for sequence in list(self.active):
+                    sequence.output.put(e)
+                    self._finish(sequence, None)
+
+    def _admit(self):
+        with self.lock:
+            while self.pending and self.free_slots:
+                sequence = self.pending.popleft()
+                if sequence.cancelled.is_set():
+                    self._finish(sequence, None)
+                    continue
+                sequence.slot = self.free_slots.pop()
+                # Drop whatever the previous owner of the slot left in the KV cache
+                llama_cpp.llama_kv_cache_seq_rm(self.ctx, sequence.slot, -1, -1)
+                self.active.append(sequence)
+                sequence.output.put(self._chunk(sequence, {"role": "assistant"}))
+            self.stats["max_active"] = max(self.stats["max_active"], len(self.active))
+
+    def _step(self):
+        for sequence in [s for s in self.active if s.cancelled.is_set()]:
+            self._finish(sequence, None)
+
+        # Generating sequences need one token each, prompts fill the rest of the batch
+        batch_sequences = []
+        n_tokens = 0
+        for sequence in self.active:
+            if sequence.next_token is not None:
+                self._add_token(n_tokens, sequence.next_token, sequence.n_past, sequence, True)
+                sequence.n_past += 1
+                batch_sequences.append((sequence, n_tokens))
+                n_tokens += 1
+        for sequence in self.active:
+            if sequence.next_token is not None or n_tokens >= self.n_batch:
+                continue
+            remaining = sequence.tokens[sequence.n_past :]
+            chunk = remaining[: self.n_batch - n_tokens]
+            for i, token in enumerate(chunk):
+                is_last = sequence.n_past + i == len(sequence.tokens) - 1
+                self._add_token(n_tokens, token, sequence.n_past + i, sequence, is_last)
+                if is_last:
+                    batch_sequences.append((sequence, n_tokens))
+                n_tokens += 1
+            sequence.n_past += len(chunk)
+        if n_tokens == 0:
+            return
+
+        self.batch.n_tokens = n_tokens
+        start_time = time.perf_counter()
+        result = llama_cpp.llama_decode(self.ctx, self.batch)
+        if result != 0:
+            raise RuntimeError(f"llama_decode returned {result}")
+
+        for sequence, index in batch_sequences:
+            token = llama_cpp.llama_sampler_sample(sequence.sampler, self.ctx, index)
+            self._emit(sequence, token)
+        self.stats["decode_time"] += time.perf_counter() - start_time
+        self.stats["generated_tokens"] += len(batch_sequences)
+
+    def _add_token(self, index: int, token: int, pos: int, sequence: Sequence, logits: bool):
+        self.batch.token[index] = token
+        self.batch.pos[index] = pos
+        self.batch.n_seq_id[index] = 1
+        self.batch.seq_id[index][0] = sequence.slot
+        self.batch.logits[index] = logits
+
+    def _emit(self, sequence: Sequence, token: int):
+        if llama_cpp.llama_token_is_eog(self.llm.model, token):
+            self._flush(sequence, final=True)
+            self._finish(sequence, "stop")
+            return
+
+        sequence.n_generated += 1
+        sequence.next_token = token
+        sequence.text += sequence.decoder.decode(self._piece(token))
+        if self._flush(sequence, final=False):
+            self._finish(sequence, "stop")
+        elif sequence.n_generated >= sequence.max_tokens:
+            self._flush(sequence, final=True)
+            self._finish(sequence, "length")
+
+    def _piece(self, token: int) -> bytes:
+        buffer = ctypes.create_string_buffer(64)
+        size = llama_cpp.llama_token_to_piece(self.llm.model, token, buffer, 64, 0, False)
+        if size < 0:
+            buffer = ctypes.create_string_buffer(-size)
+            size = llama_cpp.llama_token_to_piece(self.llm.model, token, buffer, -size, 0, False)
+        return buffer.raw[:size]
+
+    def _flush(self, sequence: Sequence, final: bool) -> bool:
+        """Emit the generated text, returns True when a stop string was reached"""
+        for stop in sequence.stop:
+            position = sequence.text.find(stop)
+            if position != -1:
+                self._put_text(sequence, sequence.text[:position])
+                sequence.text = ""
+                return True
+        # Hold back a tail that could be the start of a stop string
+        hold = 0 if final else max((len(stop) - 1 for stop in sequence.stop), default=0)
+        emit_until = len(sequence.text) - hold
+        if emit_until > 0:
+            self._put_text(sequence, sequence.text[:emit_until])
+            sequence.text = sequence.text[emit_until:]
+        return False
+
+    def _put_text(self, sequence: Sequence, text: str):
+        if text:
+            sequence.output.put(self._chunk(sequence, {"content": text}))
+
+    def _finish(self, sequence: Sequence, finish_reason: Optional[str]):
+        if sequence in self.active:
+            self.active.remove(sequence)
+        if sequence.slot is not None:
+            self.free_slots.append(sequence.slot)
+            sequence.slot = None
+        if sequence.sampler is not None:
+            llama_cpp.llama_sampler_free(sequence.sampler)
+            sequence.sampler = None
+        if finish_reason is not None:
+            sequence.output.put(self._chunk(sequence, {}, finish_reason))
+        sequence.output.put(None)
+
+    def _chunk(self, sequence: Sequence, delta: Dict, finish_reason: Optional[str] = None):
+        return {
+            "id": sequence.id,
+            "object": "chat.completion.chunk",
+            "created": sequence.created,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
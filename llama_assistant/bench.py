@@ -0,0 +1,381 @@
+import argparse
+import csv
+import html
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from llama_assistant import config, hardware
+from llama_assistant.model_registry import registry
+from llama_assistant.utils import get_resource_path
+
+METRICS = [
+    "load_time",
+    "prompt_tokens",
+    "prompt_eval_tps",
+    "time_to_first_token",
+    "generated_tokens",
+    "generation_tps",
+    "peak_rss_mb",
+]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak RSS of this process so far, every model is benchmarked in a process of its own"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+class FakeLlama:
+    """Stand-in for llama_cpp.Llama that streams canned tokens at a fixed speed"""
+
+    def __init__(self, prompt_tps: float = 400.0, generation_tps: float = 40.0):
+        self.prompt_tps = prompt_tps
+        self.generation_tps = generation_tps
+
+    def tokenize(self, text: bytes, add_bos: bool = True) -> List[int]:
+        return list(range(len(text.split()) + int(add_bos)))
+
+    def reset(self):
+        pass
+
+    def create_chat_completion(self, messages, max_tokens=None, stream=False):
+        prompt = "".join(m["content"] for m in messages).encode("utf-8")
+        time.sleep(len(self.tokenize(prompt)) / self.prompt_tps)
+        n_tokens = min(max_tokens or 64, 64)
+        yield {"choices": [{"delta": {"role": "assistant"}}]}
+        for i in range(n_tokens):
+            if i:
+                time.sleep(1 / self.generation_tps)
+            yield {"choices": [{"delta": {"content": f" token{i}"}}]}
+
+
+class LlamaBackend:
+    def load(self, model_id: str):
+        from llama_assistant.model_handler import handler as model_handler
+
+        # Measure a cold load
+        model_handler.unload_model(model_id)
+        model_data = model_handler.load_model(model_id)
+        if not model_data:
+            raise RuntimeError(f"Failed to load model: {model_id}")
+        return model_data["model"]
+
+    def unload(self, model_id: str):
+        from llama_assistant.model_handler import handler as model_handler
+
+        model_handler.unload_model(model_id)
+
+
+class FakeBackend:
+    def load(self, model_id: str):
+        time.sleep(0.05)
+        return FakeLlama()
+
+    def unload(self, model_id: str):
+        pass
+
+
+def run_prompt(model, prompt: str, max_tokens: int) -> Dict:
+    # Start from an empty context so that earlier runs cannot be reused
+    model.reset()
+    prompt_tokens = len(model.tokenize(prompt.encode("utf-8")))
+
+    generated_tokens = 0
+    first_token_time = None
+    start_time = time.perf_counter()
+    for chunk in model.create_chat_completion(
+        messages=[{"role": "user", "content": prompt}], max_tokens=max_tokens, stream=True
+    ):
+        if "content" in chunk["choices"][0]["delta"]:
+            generated_tokens += 1
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+    end_time = time.perf_counter()
+
+    if first_token_time is None:
+        first_token_time = end_time
+    time_to_first_token = first_token_time - start_time
+    generation_time = end_time - first_token_time
+    return {
+        "prompt_tokens": prompt_tokens,
+        "prompt_eval_tps": prompt_tokens / time_to_first_token if time_to_first_token else None,
+        "time_to_first_token": time_to_first_token,
+        "generated_tokens": generated_tokens,
+        "generation_tps": (
+            (generated_tokens - 1) / generation_time
+            if generated_tokens > 1 and generation_time
+            else None
+        ),
+    }
+
+
+def median(values: List) -> Optional[float]:
+    values = [v for v in values if v is not None]
+    return statistics.median(values) if values else None
+
+
+def run_benchmark(backend, model_ids: List[str], tasks: List[str], corpus: List[str], args):
+    results = []
+    # The peak RSS of a process never goes down, a fresh process per model keeps the
+    # peak of one model from showing up in the results of the next
+    context = multiprocessing.get_context("spawn")
+    for model_id in model_ids:
+        results_conn, child_conn = context.Pipe(duplex=False)
+        process = context.Process(
+            target=benchmark_model_process,
+            args=(child_conn, backend, model_id, tasks, corpus, args),
+        )
+        process.start()
+        child_conn.close()
+        try:
+            results.extend(results_conn.recv())
+        except EOFError:
+            print(f"Benchmarking {model_id} failed")
+        process.join()
+    return results
+
+
+def benchmark_model_process(conn, backend, model_id: str, tasks: List[str], corpus, args):
+    conn.send(benchmark_model(backend, model_id, tasks, corpus, args))
+    conn.close()
+
+
+def benchmark_model(backend, model_id: str, tasks: List[str], corpus: List[str], args):
+    print(f"Benchmarking {model_id}", flush=True)
+    results = []
+    start_time = time.perf_counter()
+    model = backend.load(model_id)
+    load_time = time.perf_counter() - start_time
+
+    for task in tasks:
+        runs = []
+        for _ in range(args.runs):
+            for text in corpus:
+                prompt, _ = config.get_task_prompt(task, text)
+                runs.append(run_prompt(model, prompt, args.max_tokens))
+        result = {"model_id": model_id, "task": task, "load_time": load_time}
+        for metric in METRICS[1:-1]:
+            result[metric] = median([run[metric] for run in runs])
+        result["peak_rss_mb"] = peak_rss_mb()
+        results.append(result)
+        print(
+            f"  {task}: ttft {result['time_to_first_token']:.3f}s, "
+            f"prompt {result['prompt_eval_tps'] or 0:.1f} tok/s, "
+            f"generation {result['generation_tps'] or 0:.1f} tok/s",
+            flush=True,
+        )
+
+    backend.unload(model_id)
+    return results
+
+
+def run_render_benchmark(tokens_per_second: float, seconds: float, coalesce: bool) -> Dict:
+    """Stream synthetic tokens from a thread into a chat box at the speed of a model and
+    measure the CPU time the GUI thread spends on drawing them"""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtCore import QEventLoop, QThread, QTimer, pyqtSignal
+    from PyQt5.QtGui import QTextCursor
+    from PyQt5.QtWidgets import QApplication, QTextBrowser
+
+    from llama_assistant.chat_renderer import RENDER_FPS, ChatRenderer
+    from llama_assistant.processing_thread import TokenBuffer
+
+    n_tokens = int(tokens_per_second * seconds)
+
+    class TokenStream(QThread):
+        token_signal = pyqtSignal(int, str)
+
+        def __init__(self, tokens: TokenBuffer):
+            super().__init__()
+            self.tokens = tokens
+
+        def run(self):
+            start_time = time.perf_counter()
+            for i in range(n_tokens):
+                time.sleep(max(0.0, start_time + i / tokens_per_second - time.perf_counter()))
+                # Paragraphs of a few lines, like a typical answer
+                text = "\n\n" if i % 60 == 59 else "\n" if i % 15 == 14 else f" token{i}"
+                if coalesce:
+                    self.tokens.append(0, text)
+                else:
+                    self.token_signal.emit(0, text)
+
+    app = QApplication.instance() or QApplication([])
+    chat_box = QTextBrowser()
+    chat_box.resize(400, 500)
+    chat_box.show()
+    renderer = ChatRenderer(chat_box)
+    # Loads the Markdown extensions before the measurement
+    renderer._markdown("warm up")
+    tokens = TokenBuffer()
+    stream = TokenStream(tokens)
+    loop = QEventLoop()
+    inserts = {"count": 0, "slowest": 0.0}
+
+    def timed(function):
+        def wrapper(*args):
+            start_time = time.perf_counter()
+            if function(*args) is not False:
+                inserts["count"] += 1
+                inserts["slowest"] = max(inserts["slowest"], time.perf_counter() - start_time)
+
+        return wrapper
+
+    @timed
+    def insert_token(request_id: int, text: str):
+        # How every token was drawn before the tokens were batched
+        cursor = QTextCursor(chat_box.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.insertHtml(html.escape(text).replace("\n", "<br>"))
+        renderer.scroll_to_bottom()
+
+    @timed
+    def flush():
+        chunks = tokens.take()
+        for request_id, text in chunks:
+            renderer.append_text(text)
+        renderer.refresh()
+        return bool(chunks)
+
+    def finish():
+        if coalesce:
+            flush()
+            renderer.finish_response()
+        loop.quit()
+
+    timer = QTimer()
+    if coalesce:
+        timer.setInterval(1000 // RENDER_FPS)
+        timer.timeout.connect(flush)
+        timer.start()
+    else:
+        stream.token_signal.connect(insert_token)
+    # Queued behind the tokens that the stream emitted before it finished
+    stream.finished.connect(finish)
+
+    start_time = time.perf_counter()
+    start_cpu_time = time.thread_time()
+    stream.start()
+    loop.exec_()
+    cpu_time = time.thread_time() - start_cpu_time
+    elapsed = time.perf_counter() - start_time
+    timer.stop()
+    stream.wait()
+    chat_box.close()
+    app.processEvents()
+    return {
+        "mode": "coalesced" if coalesce else "per_token",
+        "tokens": n_tokens,
+        "inserts": inserts["count"],
+        "seconds": elapsed,
+        "gui_ms_per_second": cpu_time * 1000 / elapsed,
+        "slowest_insert_ms": inserts["slowest"] * 1000,
+    }
+
+
+def write_results(report: Dict, output_dir: Path) -> Path:
+    output_dir.mkdir(parents=True, exist_ok=True)
+    name = time.strftime("bench-%Y%m%d-%H%M%S")
+    json_path = output_dir / f"{name}.json"
+    with open(json_path, "w") as f:
+        json.dump(report, f, indent=2)
+    with open(output_dir / f"{name}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["model_id", "task"] + METRICS)
+        writer.writeheader()
+        writer.writerows(report["results"])
+    return json_path
+
+
+def compare_results(report: Dict, baseline: Dict):
+    baseline_results = {(r["model_id"], r["task"]): r for r in baseline["results"]}
+    print(f"\nComparison with the run from {baseline['timestamp']}:")
+    for result in report["results"]:
+        previous = baseline_results.get((result["model_id"], result["task"]))
+        if previous is None:
+            continue
+        changes = []
+        for metric in ["load_time", "time_to_first_token", "prompt_eval_tps", "generation_tps"]:
+            if result[metric] and previous.get(metric):
+                change = (result[metric] - previous[metric]) / previous[metric] * 100
+                changes.append(f"{metric} {change:+.1f}%")
+        print(f"  {result['model_id']} / {result['task']}: {', '.join(changes)}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="llama-assistant bench", description="Benchmark the configured models"
+    )
+    parser.add_argument("--models", nargs="+", help="Model IDs (default: all text models)")
+    parser.add_argument(
+        "--tasks", nargs="+", choices=list(config.TASK_PROMPTS), default=list(config.TASK_PROMPTS)
+    )
+    parser.add_argument(
+        "--corpus",
+        type=Path,
+        default=Path(get_resource_path("llama_assistant/resources/bench_corpus.json")),
+    )
+    parser.add_argument("--runs", type=int, default=1, help="Repetitions of the corpus")
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument(
+        "--output-dir", type=Path, default=config.llama_assistant_dir / "benchmarks"
+    )
+    parser.add_argument("--compare", type=Path, help="JSON results of an earlier run")
+    parser.add_argument(
+        "--fake", action="store_true", help="Use a fake backend that needs no model files"
+    )
+    parser.add_argument(
+        "--render",
+        action="store_true",
+        help="Measure the GUI thread time of drawing a synthetic token stream instead",
+    )
+    parser.add_argument("--render-tps", type=float, default=50.0, help="Streamed tokens/s")
+    parser.add_argument("--render-seconds", type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    if args.render:
+        for coalesce in (False, True):
+            result = run_render_benchmark(args.render_tps, args.render_seconds, coalesce)
+            print(
+                f"{result['mode']}: {result['gui_ms_per_second']:.1f} ms of GUI thread time "
+                f"per second, {result['inserts']} inserts for {result['tokens']} tokens, "
+                f"slowest {result['slowest_insert_ms']:.1f} ms"
+            )
+        return 0
+
+    model_ids = args.models or [m.model_id for m in registry.list("text")]
+    with open(args.corpus) as f:
+        corpus = json.load(f)["texts"]
+
+    backend = FakeBackend() if args.fake else LlamaBackend()
+    results = run_benchmark(backend, model_ids, args.tasks, corpus, args)
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "fake": args.fake,
+        "host": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "physical_cores": hardware.physical_core_count(),
+            "logical_cores": hardware.logical_core_count(),
+            "memory_total": hardware.memory_info()["total"],
+        },
+        "results": results,
+    }
+    json_path = write_results(report, args.output_dir)
+    print(f"Results written to {json_path} and {json_path.with_suffix('.csv')}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(report, json.load(f))
+    return 0
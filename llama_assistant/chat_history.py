@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+from array import array
+from collections import deque
+
+from PyQt5.QtGui import QTextCursor, QTextDocumentFragment
+
+
+class ChatHistory:
+    """Keeps a window of recent messages in the chat box and pages older ones to disk.
+
+    A message starts with begin_message and runs until the next one. Messages that fall
+    out of the window are written to a spool file as HTML and only their offsets stay in
+    memory. Scrolling to the top loads them back a page at a time, and the next message
+    trims the window again, so the document does not grow over a long session.
+    """
+
+    def __init__(self, chat_box, max_messages: int = 50, page_size: int = 10):
+        self.chat_box = chat_box
+        self.max_messages = max(max_messages, 1)
+        self.page_size = page_size
+        self.spool = tempfile.TemporaryFile(prefix="llama-assistant-chat-")
+        self.offsets = array("q")  # Offset of every message written to the spool
+        self.starts = deque()  # Cursor at the start of every message in the chat box
+        self.first_visible = 0  # Index of the oldest message in the chat box
+        self.chat_box.verticalScrollBar().valueChanged.connect(self.on_scroll)
+
+    def begin_message(self):
+        """Start a message at the end of the chat box, paging out the oldest ones"""
+        while len(self.starts) >= self.max_messages:
+            self._page_out()
+        cursor = QTextCursor(self.chat_box.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.setKeepPositionOnInsert(True)
+        self.starts.append(cursor)
+
+    def clear(self):
+        # Before clearing the chat box, which scrolls it to the top
+        self.starts.clear()
+        self.spool.seek(0)
+        self.spool.truncate()
+        self.offsets = array("q")
+        self.first_visible = 0
+        self.chat_box.clear()
+
+    def on_scroll(self, value: int):
+        if value == self.chat_box.verticalScrollBar().minimum() and self.first_visible > 0:
+            self.load_older()
+
+    def load_older(self):
+        """Load a page of messages from the spool above the oldest one in the chat box"""
+        scroll_bar = self.chat_box.verticalScrollBar()
+        old_maximum = scroll_bar.maximum()
+        document = self.chat_box.document()
+        for _ in range(min(self.page_size, self.first_visible)):
+            self.first_visible -= 1
+            self.spool.seek(self.offsets[self.first_visible])
+            html = json.loads(self.spool.readline())["html"]
+
+            cursor = QTextCursor(document)
+            cursor.insertFragment(QTextDocumentFragment.fromHtml(html))
+            if self.starts:
+                # Cursors that keep their position on insert stay in front of the text
+                self.starts[0].setPosition(cursor.position())
+            start = QTextCursor(document)
+            start.setKeepPositionOnInsert(True)
+            self.starts.appendleft(start)
+        # Keep the text that was at the top of the view in place
+        scroll_bar.setValue(scroll_bar.value() + scroll_bar.maximum() - old_maximum)
+
+    def _page_out(self):
+        # Only the position of the start cursors stays in place on insert, not the anchor
+        cursor = QTextCursor(self.chat_box.document())
+        cursor.setPosition(self.starts.popleft().position())
+        if self.starts:
+            cursor.setPosition(self.starts[0].position(), QTextCursor.MoveMode.KeepAnchor)
+        else:
+            cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
+        if self.first_visible == len(self.offsets):
+            # Messages loaded back from the spool are already in it
+            self.spool.seek(0, os.SEEK_END)
+            self.offsets.append(self.spool.tell())
+            record = {"html": cursor.selection().toHtml()}
+            self.spool.write((json.dumps(record) + "\n").encode("utf-8"))
+        cursor.removeSelectedText()
+        self.first_visible += 1
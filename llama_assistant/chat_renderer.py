@@ -0,0 +1,157 @@
+import html
+import re
+import time
+
+import markdown
+from PyQt5.QtGui import QTextBlockFormat, QTextCharFormat, QTextCursor
+
+# Streamed text is drawn at most this often, however fast the tokens arrive
+RENDER_FPS = 30
+
+FENCE_PATTERN = re.compile(r"^ {0,3}(```+|~~~+)")
+LIST_ITEM_PATTERN = re.compile(r"^ {0,3}([*+-]|\d+[.)])[ \t]")
+# Share of the time that re-rendering the open block may take. A long table or list
+# without a blank line is redrawn less often instead of slowing the GUI down.
+MAX_RENDER_SHARE = 0.25
+CODE_LINE_HTML = '<pre style="margin-top: 0; margin-bottom: 0;">{}</pre>'
+
+
+class ChatRenderer:
+    """Renders streamed responses into the chat box as Markdown, block by block.
+
+    Only the last, still open block (a paragraph, a list, a table or the current line
+    of a fenced code block) is rendered again when tokens arrive. Blocks that are
+    complete are rendered once and left alone in the document, so the cost of a frame
+    does not grow with the length of the answer.
+    """
+
+    def __init__(self, chat_box):
+        self.chat_box = chat_box
+        self.begin_response()
+
+    def begin_response(self):
+        """Start a new response at the end of the document"""
+        self.source = ""
+        self.block_start = 0  # Start of the open block in the source
+        self.scan_pos = 0  # Start of the first line that has not been scanned
+        self.fence = None  # Marker of the open fenced code block
+        self.after_blank_line = False  # The open list or indented code may have ended
+        self.dirty = False  # The open block has text that is not rendered yet
+        self.next_render = 0.0
+        # Cursors instead of offsets, older messages can be loaded above the response
+        self.response_position = self._end_cursor()
+        self.open_position = self._end_cursor()
+
+    def append_text(self, text: str):
+        self.source += text
+        self._freeze_complete_blocks()
+        self.dirty = True
+        self.refresh()
+
+    def refresh(self):
+        """Render the open block if it changed and the render budget allows it"""
+        now = time.perf_counter()
+        if not self.dirty or now < self.next_render:
+            return
+        self._render_open_block(final=False)
+        self.dirty = False
+        self.next_render = now + (time.perf_counter() - now) / MAX_RENDER_SHARE
+        self.scroll_to_bottom()
+
+    def finish_response(self):
+        """Render the rest of the response and freeze it"""
+        self._render_open_block(final=True)
+        self.begin_response()
+
+    def scroll_to_bottom(self):
+        scroll_bar = self.chat_box.verticalScrollBar()
+        scroll_bar.setValue(scroll_bar.maximum())
+
+    def _freeze_complete_blocks(self):
+        frozen_html = []
+        while True:
+            line_end = self.source.find("\n", self.scan_pos)
+            if line_end == -1:
+                break
+            line_end += 1
+            line = self.source[self.scan_pos : line_end]
+
+            if self.fence is not None:
+                if line.strip().startswith(self.fence):
+                    self.fence = None
+                else:
+                    # Lines of a code block are complete on their own
+                    frozen_html.append(CODE_LINE_HTML.format(html.escape(line.rstrip("\n"))))
+                self.block_start = line_end
+            elif not line.strip():
+                if self._open_block_continues_after_blank_line():
+                    self.after_blank_line = True
+                else:
+                    frozen_html.append(self._markdown(self.source[self.block_start : line_end]))
+                    self.block_start = line_end
+            else:
+                if self.after_blank_line and not (
+                    line[0] in " \t" or LIST_ITEM_PATTERN.match(line)
+                ):
+                    # The list or indented code ended at the blank line before this one
+                    frozen_html.append(
+                        self._markdown(self.source[self.block_start : self.scan_pos])
+                    )
+                    self.block_start = self.scan_pos
+                self.after_blank_line = False
+                fence_match = FENCE_PATTERN.match(line)
+                if fence_match:
+                    frozen_html.append(
+                        self._markdown(self.source[self.block_start : self.scan_pos])
+                    )
+                    self.block_start = line_end
+                    self.fence = fence_match.group(1)
+            self.scan_pos = line_end
+
+        frozen_html = "".join(frozen_html)
+        if frozen_html:
+            self._replace_open_block(frozen_html)
+            self.open_position = self._end_cursor()
+
+    def _open_block_continues_after_blank_line(self) -> bool:
+        """Lists and indented code go on after a blank line, other blocks end there"""
+        first_line_end = self.source.find("\n", self.block_start, self.scan_pos)
+        if first_line_end == -1:
+            return False  # The open block is empty
+        first_line = self.source[self.block_start : first_line_end]
+        return first_line.startswith(("    ", "\t")) or bool(LIST_ITEM_PATTERN.match(first_line))
+
+    def _render_open_block(self, final: bool):
+        text = self.source[self.block_start :]
+        if self.fence is not None:
+            block_html = CODE_LINE_HTML.format(html.escape(text)) if text else ""
+        else:
+            block_html = self._markdown(text)
+        self._replace_open_block(block_html)
+        if final:
+            self.open_position = self._end_cursor()
+
+    def _replace_open_block(self, block_html: str):
+        cursor = QTextCursor(self.chat_box.document())
+        cursor.setPosition(self.open_position.position())
+        cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
+        cursor.removeSelectedText()
+        if block_html:
+            # HTML inserted at the end of a block joins that block, the first block of the
+            # response stays next to its label and later ones start a clean block
+            if self.open_position.position() > self.response_position.position():
+                cursor.insertBlock(QTextBlockFormat(), QTextCharFormat())
+            cursor.insertHtml(block_html)
+
+    def _end_cursor(self) -> QTextCursor:
+        cursor = QTextCursor(self.chat_box.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        # Stays in front of the text that is inserted at its position
+        cursor.setKeepPositionOnInsert(True)
+        return cursor
+
+    @staticmethod
+    def _markdown(text: str) -> str:
+        if not text.strip():
+            return ""
+        return markdown.markdown(text, extensions=["tables", "sane_lists"])
@@ -0,0 +1,41 @@
+import uuid
+from typing import Dict, List, Optional
+
+
+class ChatSession:
+    """Message history of a conversation and the llama.cpp state that matches it.
+
+    ModelHandler restores the state before each turn when the model was used for
+    something else in between, so llama.cpp only evaluates the newly appended
+    messages instead of the whole transcript.
+    """
+
+    def __init__(self, model_id: str, reserved_tokens: int = 512, session_id: Optional[str] = None):
+        # Identifies the conversation across processes, e.g. in the inference worker
+        self.session_id = session_id or uuid.uuid4().hex
+        self.model_id = model_id
+        self.reserved_tokens = reserved_tokens
+        self.messages: List[Dict] = []
+        self.state: Optional[Dict] = None
+
+    def add_turn(self, user_message: str, assistant_message: str):
+        self.messages.append({"role": "user", "content": user_message})
+        self.messages.append({"role": "assistant", "content": assistant_message})
+
+    def build_messages(self, message: str) -> List[Dict]:
+        return self.messages + [{"role": "user", "content": message}]
+
+    def trim(self, model, message: str):
+        """Drop the oldest turns until the transcript fits in the context window"""
+        while self.messages:
+            text = "".join(m["content"] for m in self.build_messages(message))
+            n_tokens = len(model.tokenize(text.encode("utf-8"), add_bos=False))
+            if n_tokens + self.reserved_tokens <= model.n_ctx():
+                break
+            # The transcript no longer starts with the cached tokens
+            self.messages = self.messages[2:]
+            self.state = None
+
+    def reset(self):
+        self.messages = []
+        self.state = None
@@ -11,6 +11,32 @@ DEFAULT_SETTINGS = {
     "multimodal_model": "vikhyatk/moondream2",
     "hey_llama_chat": False,
     "hey_llama_mic": False,
+    "model_memory_budget_gb": 8,
+    # Seconds after which an unused model is unloaded, 0 keeps models loaded
+    "model_idle_ttl": 3600,
+    # Free memory (percent of the total) below which models are unloaded early
+    "memory_pressure_percent": 10,
+    # Sequences decoded together per model by the API server, 1 runs them one by one
+    "batching_slots": 1,
+    # Messages kept in the chat box, older ones are loaded from disk when scrolling up
+    "chat_window_messages": 50,
+    # Save every exchange to a local database that /search looks through
+    "conversation_history": True,
+    "response_cache": True,
+    "semantic_cache": False,
+    "semantic_cache_threshold": 0.92,
+    "embedding_model": "CompendiumLabs/bge-small-en-v1.5-gguf",
+    # Image embeddings of the vision encoders kept for follow-up questions about an image
+    "image_embedding_cache_mb": 512,
+    "image_embedding_disk_cache": False,
+}
+TASK_PROMPTS = {
+    "chat": "{message} \nGenerate a short and simple response.",
+    "Summarize": "Summarize the following text: {message}",
+    "Rephrase": "Rephrase the following text {message}",
+    "Fix Grammar": "Fix the grammar in the following text:\n {message}",
+    "Brainstorm": "Brainstorm ideas related to: {message}",
+    "Write Email": "Write an email about: {message}",
 }
 DEFAULT_MODELS = [
     {
@@ -109,6 +135,15 @@ DEFAULT_MODELS = [
         "repo_id": "openbmb/MiniCPM-V-2_6-gguf",
         "filename": "*Q8_0.gguf",
     },
+    {
+        "model_name": "bge-small-en-v1.5-gguf",
+        "model_id": "CompendiumLabs/bge-small-en-v1.5-gguf",
+        "model_type": "embedding",
+        "model_path": None,
+        "repo_id": "CompendiumLabs/bge-small-en-v1.5-gguf",
+        "filename": "*q8_0.gguf",
+        "runtime": {"embedding": True, "n_ctx": 512},
+    },
 ]
 
 
@@ -117,6 +152,15 @@ llama_assistant_dir = home_dir / "llama_assistant"
 pathlib.Path.mkdir(llama_assistant_dir, parents=True, exist_ok=True)
 custom_models_file = llama_assistant_dir / "custom_models.json"
 settings_file = llama_assistant_dir / "settings.json"
+prefix_cache_dir = llama_assistant_dir / "prefix_cache"
+autotune_file = llama_assistant_dir / "autotune.json"
+response_cache_file = llama_assistant_dir / "response_cache.db"
+semantic_cache_dir = llama_assistant_dir / "semantic_cache"
+image_embedding_cache_dir = llama_assistant_dir / "image_embedding_cache"
+daemon_socket_file = llama_assistant_dir / "daemon.sock"
+daemon_key_file = llama_assistant_dir / "daemon.key"
+conversation_db_file = llama_assistant_dir / "conversations.db"
+models_dir = llama_assistant_dir / "models"
 
 if custom_models_file.exists():
     with open(custom_models_file, "r") as f:
@@ -139,6 +183,24 @@ if not custom_models_file.exists():
         json.dump({"custom_models": custom_models}, f, indent=2)
 
 
+def get_task_prompt(task, message):
+    """Return the prompt for a task and the fixed template text that precedes the message"""
+    template = TASK_PROMPTS[task]
+    return template.format(message=message), template.split("{message}")[0]
+
+
+def load_settings():
+    """Settings of the GUI merged over the defaults, for the headless commands"""
+    settings = dict(DEFAULT_SETTINGS)
+    if settings_file.exists():
+        with open(settings_file, "r") as f:
+            try:
+                settings.update(json.load(f))
+            except json.JSONDecodeError:
+                pass
+    return settings
+
+
 # Save the custom models to the file
 def save_custom_models():
     global models
@@ -0,0 +1,181 @@
+import argparse
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from llama_assistant import config
+
+# Marks the matched terms in snippets, control characters do not occur in chat text
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+
+class ConversationStore:
+    """Every chat exchange in SQLite, with an FTS5 index over prompts and responses.
+
+    Exchanges are queued and written by a background thread, which puts all exchanges
+    that arrive within flush_interval into one transaction, so the caller never waits
+    for the disk. Searches read through their own connection, which WAL mode lets run
+    next to the writer.
+    """
+
+    def __init__(
+        self,
+        db_path: Path = config.conversation_db_file,
+        flush_interval: float = 0.5,
+        batch_size: int = 512,
+    ):
+        self.db_path = str(db_path)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue: "queue.Queue" = queue.Queue()
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS exchanges (
+                id INTEGER PRIMARY KEY,
+                session_id TEXT,
+                task TEXT,
+                model_id TEXT,
+                prompt TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS exchanges_session ON exchanges (session_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS exchanges_fts USING fts5 (
+                prompt, response, content='exchanges', content_rowid='id'
+            );
+            CREATE TRIGGER IF NOT EXISTS exchanges_insert AFTER INSERT ON exchanges BEGIN
+                INSERT INTO exchanges_fts (rowid, prompt, response)
+                VALUES (new.id, new.prompt, new.response);
+            END;
+            CREATE TRIGGER IF NOT EXISTS exchanges_delete AFTER DELETE ON exchanges BEGIN
+                INSERT INTO exchanges_fts (exchanges_fts, rowid, prompt, response)
+                VALUES ('delete', old.id, old.prompt, old.response);
+            END;
+            """
+        )
+        self.db.commit()
+
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def add_exchange(
+        self,
+        prompt: str,
+        response: str,
+        session_id: Optional[str] = None,
+        task: Optional[str] = None,
+        model_id: Optional[str] = None,
+    ):
+        """Queue an exchange to be written, returns at once"""
+        self.queue.put(("exchange", (session_id, task, model_id, prompt, response, time.time())))
+
+    def flush(self):
+        """Wait until the queued exchanges are written"""
+        done = threading.Event()
+        self.queue.put(("flush", done))
+        done.wait()
+
+    def close(self):
+        done = threading.Event()
+        self.queue.put(("close", done))
+        done.wait()
+        self.writer.join()
+        with self.lock:
+            self.db.close()
+
+    def count(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM exchanges").fetchone()[0]
+
+    def search(self, query: str, limit: int = 20) -> List[Dict]:
+        """Newest exchanges that contain all words of the query, the last one as a prefix"""
+        match = to_match_expression(query)
+        if not match:
+            return []
+        with self.lock:
+            rows = self.db.execute(
+                f"""
+                SELECT e.id, e.session_id, e.task, e.model_id, e.created,
+                    snippet(exchanges_fts, 0, '{MATCH_START}', '{MATCH_END}', '...', 16),
+                    snippet(exchanges_fts, 1, '{MATCH_START}', '{MATCH_END}', '...', 24)
+                FROM exchanges_fts JOIN exchanges e ON e.id = exchanges_fts.rowid
+                WHERE exchanges_fts MATCH ?
+                ORDER BY exchanges_fts.rowid DESC
+                LIMIT ?
+                """,
+                (match, limit),
+            ).fetchall()
+        keys = ["id", "session_id", "task", "model_id", "created", "prompt", "response"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def _write_loop(self):
+        db = sqlite3.connect(self.db_path)
+        db.execute("PRAGMA synchronous=NORMAL")
+        running = True
+        while running:
+            items = [self.queue.get()]
+            # Exchanges that arrive shortly after go into the same transaction
+            deadline = time.monotonic() + self.flush_interval
+            while items[-1][0] == "exchange" and len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            rows = [args for kind, args in items if kind == "exchange"]
+            if rows:
+                try:
+                    with db:
+                        db.executemany(
+                            "INSERT INTO exchanges "
+                            "(session_id, task, model_id, prompt, response, created) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            rows,
+                        )
+                except sqlite3.Error as e:
+                    print(f"Error saving {len(rows)} exchanges: {e}")
+            for kind, args in items:
+                if kind in ("flush", "close"):
+                    args.set()
+                running = running and kind != "close"
+        db.close()
+
+
+def to_match_expression(query: str) -> str:
+    """FTS5 query for the words of a search, without operators that could fail to parse"""
+    words = [word.replace('"', '""') for word in query.split()]
+    if not words:
+        return ""
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="llama-assistant search", description="Search the saved conversations"
+    )
+    parser.add_argument("query", nargs="+")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    store = ConversationStore()
+    start_time = time.perf_counter()
+    results = store.search(" ".join(args.query), args.limit)
+    elapsed = time.perf_counter() - start_time
+    for result in results:
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(result["created"]))
+        print(f"[{created}] {result['task'] or 'chat'} - {result['model_id'] or ''}")
+        for key in ("prompt", "response"):
+            text = result[key].replace(MATCH_START, "\033[1m").replace(MATCH_END, "\033[0m")
+            print(f"  {key.capitalize()}: {' '.join(text.split())}")
+        print()
+    print(f"{len(results)} of {store.count()} exchanges in {elapsed * 1000:.1f} ms")
+    store.close()
+    return 0
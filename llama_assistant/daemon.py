@@ -0,0 +1,149 @@
+import argparse
+import os
+import secrets
+import sys
+import threading
+from multiprocessing.connection import AuthenticationError, Client, Listener
+from typing import List, Optional
+
+from llama_assistant import config
+from llama_assistant.inference_worker import TokenRing, WorkerClient, WorkerServer
+
+
+def get_address() -> str:
+    if sys.platform == "win32":
+        return r"\\.\pipe\llama-assistant-daemon"
+    return str(config.daemon_socket_file)
+
+
+def get_authkey() -> bytes:
+    # Only the user's own processes can read the key, which also guards the named pipe on
+    # Windows where there are no file permissions on the address
+    try:
+        fd = os.open(config.daemon_key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, "wb") as f:
+            f.write(secrets.token_bytes(32))
+    return config.daemon_key_file.read_bytes()
+
+
+def connect(ring_name: Optional[str] = None):
+    """Connection to the running daemon, or None if there is none"""
+    address = get_address()
+    if sys.platform != "win32" and not os.path.exists(address):
+        return None
+    try:
+        conn = Client(address, authkey=get_authkey())
+    except (OSError, EOFError, AuthenticationError):
+        return None
+    if ring_name is not None:
+        conn.send(("hello", ring_name))
+    return conn
+
+
+class Daemon:
+    """Keeps the model pool warm and serves the GUI instances and CLI clients of this user"""
+
+    def __init__(self, address: str):
+        self.address = address
+        self.listener = Listener(address, authkey=get_authkey())
+        if sys.platform != "win32":
+            os.chmod(address, 0o600)
+        self.server = WorkerServer()
+        self.running = True
+
+    def preload(self, model_ids: List[str]):
+        def warm_up():
+            for model_id in model_ids:
+                if self.server.model_handler.warm_up(model_id):
+                    print(f"Model ready: {model_id}")
+
+        # In the background, so that clients can attach while the models load
+        threading.Thread(target=warm_up, daemon=True).start()
+
+    def serve_forever(self):
+        print(f"Daemon listening on {self.address}")
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except AuthenticationError:
+                print("Rejected a client with a wrong key")
+                continue
+            if not self.running:
+                conn.close()
+                break
+            threading.Thread(target=self.handle_client, args=(conn,), daemon=True).start()
+        self.server.stop()
+
+    def handle_client(self, conn):
+        try:
+            command, *args = conn.recv()
+        except (EOFError, OSError):
+            conn.close()
+            return
+
+        if command == "shutdown":
+            print("Shutting down")
+            self.running = False
+            conn.close()
+            # Wake up the accept call of the main thread
+            Client(self.address, authkey=get_authkey()).close()
+            return
+        if command != "hello" or args[0] is None:
+            conn.close()
+            return
+
+        ring = TokenRing(name=args[0], track=False)
+        print(f"Client attached, ring {ring.name}")
+        try:
+            self.server.serve_client(WorkerClient(conn, ring))
+        finally:
+            print(f"Client detached, ring {ring.name}")
+            ring.close()
+            conn.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="llama-assistant daemon",
+        description="Keep models loaded in the background for the GUI and the ask command",
+    )
+    parser.add_argument(
+        "--preload",
+        nargs="*",
+        help="Model IDs to load on start (default: the configured text model)",
+    )
+    parser.add_argument("--stop", action="store_true", help="Stop the running daemon")
+    args = parser.parse_args(argv)
+
+    address = get_address()
+    conn = connect()
+    if args.stop:
+        if conn is None:
+            print("No daemon is running")
+            return 1
+        conn.send(("shutdown",))
+        conn.close()
+        return 0
+    if conn is not None:
+        conn.close()
+        print(f"A daemon is already listening on {address}")
+        return 1
+    if sys.platform != "win32" and os.path.exists(address):
+        # Left behind by a daemon that did not exit cleanly
+        os.unlink(address)
+
+    settings = config.load_settings()
+    daemon = Daemon(address)
+    daemon.server.model_handler.apply_settings(settings)
+    preload = args.preload if args.preload is not None else [settings["text_model"]]
+    daemon.preload(preload)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        daemon.server.stop()
+    finally:
+        daemon.listener.close()
+    return 0
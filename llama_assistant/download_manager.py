@@ -0,0 +1,419 @@
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from llama_assistant import config
+from llama_assistant.model_registry import registry
+
+# Hugging Face Hub, or a mirror or local stand-in that serves the same two endpoints:
+# /api/models/<repo>/tree/main and /<repo>/resolve/main/<file>
+DEFAULT_ENDPOINT = os.environ.get("HF_ENDPOINT", "https://huggingface.co")
+CLIP_PATTERN = "*mmproj*"
+LINK_NEXT_PATTERN = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+# Called with the phase ("downloading" or "verifying"), the bytes done and the total
+ProgressCallback = Callable[[str, int, int], None]
+
+
+class DownloadError(Exception):
+    pass
+
+
+@contextmanager
+def file_lock(path: Path):
+    """Exclusive lock shared by all processes, released if the holder dies"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+
+            while True:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK gives up after 10 seconds
+        else:
+            import fcntl
+
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        if sys.platform == "win32":
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        os.close(fd)
+
+
+def find_in_hf_cache(repo_id: str, filename: str, size: int) -> Optional[str]:
+    try:
+        from huggingface_hub import try_to_load_from_cache
+    except ImportError:
+        return None
+    path = try_to_load_from_cache(repo_id, filename)
+    if isinstance(path, str) and os.path.getsize(path) == size:
+        return path
+    return None
+
+
+class DownloadManager:
+    """Downloads the GGUF files of online models into models_dir and indexes them.
+
+    Large files are fetched as parallel HTTP range requests into a .part file, and the
+    bytes done per segment are saved next to it, so an interrupted download continues
+    where it stopped. Files are checked against the SHA-256 the Hub reports before they
+    get their final name. index.json maps each model ID to its local files, so loading a
+    downloaded model needs no network access.
+    """
+
+    def __init__(
+        self,
+        models_dir: Path = config.models_dir,
+        endpoint: str = DEFAULT_ENDPOINT,
+        segments: int = 4,
+        min_segment_size: int = 32 * 1024**2,
+        chunk_size: int = 1024**2,
+        timeout: float = 30,
+        retries: int = 3,
+    ):
+        self.models_dir = Path(models_dir)
+        self.models_dir.mkdir(parents=True, exist_ok=True)
+        self.index_file = self.models_dir / "index.json"
+        self.endpoint = endpoint.rstrip("/")
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def get_local_files(self, model_id: str, repo_id: str, filename: str) -> Optional[Dict]:
+        """Local files of a downloaded model, None if it is not downloaded"""
+        entry = self._read_index().get(model_id)
+        # A custom model can be edited to point at other files under the same ID
+        if entry is None or (entry["repo_id"], entry.get("filename")) != (repo_id, filename):
+            return None
+        for key in ("model_path", "clip_model_path"):
+            if entry.get(key) and not os.path.exists(entry[key]):
+                return None
+        return entry
+
+    def ensure(
+        self,
+        model_id: str,
+        repo_id: str,
+        filename: str,
+        model_type: str,
+        progress: Optional[ProgressCallback] = None,
+    ) -> Dict:
+        """Local files of a model, downloading the ones that are missing"""
+        entry = self.get_local_files(model_id, repo_id, filename)
+        if entry is not None:
+            return entry
+
+        patterns = {"model_path": filename}
+        if model_type == "image":
+            patterns["clip_model_path"] = CLIP_PATTERN
+        files = self.resolve_files(repo_id, patterns)
+
+        total = sum(f["size"] for f in files.values())
+        finished = 0
+        entry = {"repo_id": repo_id, "filename": filename}
+        for key, remote_file in files.items():
+
+            def file_progress(phase: str, done: int, size: int, finished=finished):
+                if progress is not None:
+                    progress(phase, finished + done, total)
+
+            path = find_in_hf_cache(repo_id, remote_file["path"], remote_file["size"])
+            if path is not None:
+                # Already downloaded by an earlier version that used Llama.from_pretrained
+                finished += remote_file["size"]
+                entry[key] = path
+                continue
+            path = self.models_dir / repo_id / remote_file["path"]
+            self.download_file(
+                self.get_file_url(repo_id, remote_file["path"]),
+                path,
+                remote_file["size"],
+                remote_file["sha256"],
+                file_progress,
+            )
+            finished += remote_file["size"]
+            entry[key] = str(path)
+        self._update_index(model_id, entry)
+        return entry
+
+    def list_remote_files(self, repo_id: str) -> List[Dict]:
+        """Files in the repository, including the ones in subfolders"""
+        url = f"{self.endpoint}/api/models/{repo_id}/tree/main?recursive=true"
+        files = []
+        try:
+            while url:
+                with urllib.request.urlopen(self._request(url), timeout=self.timeout) as response:
+                    files.extend(json.load(response))
+                    # Long listings come in pages, linked like in the GitHub API
+                    next_page = LINK_NEXT_PATTERN.search(response.headers.get("Link", ""))
+                url = next_page.group(1) if next_page else None
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            raise DownloadError(f"Failed to list the files of {repo_id}: {e}")
+        return files
+
+    def resolve_files(self, repo_id: str, patterns: Dict[str, str]) -> Dict[str, Dict]:
+        """Remote file for each pattern, which must match exactly one file like in
+        Llama.from_pretrained"""
+        remote_files = [f for f in self.list_remote_files(repo_id) if f.get("type") == "file"]
+        files = {}
+        for key, pattern in patterns.items():
+            matches = [f for f in remote_files if fnmatch.fnmatch(f["path"], pattern)]
+            if len(matches) != 1:
+                found = ", ".join(f["path"] for f in matches) or "none"
+                raise DownloadError(f"Expected one file matching {pattern} in {repo_id}: {found}")
+            lfs = matches[0].get("lfs") or {}
+            files[key] = {
+                "path": matches[0]["path"],
+                "size": int(lfs.get("size", matches[0].get("size", 0))),
+                # Only files stored in LFS have a SHA-256, the others have a git hash
+                "sha256": lfs.get("oid"),
+            }
+        return files
+
+    def get_file_url(self, repo_id: str, path: str) -> str:
+        return f"{self.endpoint}/{repo_id}/resolve/main/{urllib.parse.quote(path)}"
+
+    def download_file(
+        self,
+        url: str,
+        path: Path,
+        size: int,
+        sha256: Optional[str] = None,
+        progress: Optional[ProgressCallback] = None,
+    ):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # The GUI and the inference worker may both want the same model
+        with file_lock(path.with_name(path.name + ".lock")):
+            if path.exists() and path.stat().st_size == size:
+                return  # Finished by another process, files are only renamed once verified
+            part_path = path.with_name(path.name + ".part")
+            state_path = path.with_name(path.name + ".part.json")
+            segments = self._load_segments(part_path, state_path, size)
+            if segments is None:
+                segments = self._plan_segments(url, size)
+                with open(part_path, "wb") as f:
+                    f.truncate(size)
+
+            state_lock = threading.Lock()
+            done = [sum(s["done"] for s in segments)]
+            last_saved = [done[0]]
+
+            def on_bytes(n_bytes: int):
+                with state_lock:
+                    done[0] += n_bytes
+                    if done[0] - last_saved[0] >= 8 * self.chunk_size:
+                        self._save_segments(state_path, size, segments)
+                        last_saved[0] = done[0]
+                if progress is not None:
+                    progress("downloading", done[0], size)
+
+            # Set when a segment fails, so that the others stop too
+            stop = threading.Event()
+            try:
+                with ThreadPoolExecutor(len(segments)) as pool:
+                    futures = [
+                        pool.submit(self._download_segment, url, part_path, segment, on_bytes, stop)
+                        for segment in segments
+                    ]
+                    try:
+                        for future in futures:
+                            future.result()
+                    except BaseException:
+                        stop.set()
+                        raise
+            finally:
+                with state_lock:
+                    self._save_segments(state_path, size, segments)
+
+            if sha256 is not None:
+                if progress is not None:
+                    progress("verifying", size, size)
+                actual = self._file_sha256(part_path)
+                if actual != sha256:
+                    part_path.unlink(missing_ok=True)
+                    state_path.unlink(missing_ok=True)
+                    raise DownloadError(f"Checksum mismatch for {path.name}: {actual} != {sha256}")
+            os.replace(part_path, path)
+            state_path.unlink(missing_ok=True)
+
+    def _plan_segments(self, url: str, size: int) -> List[Dict]:
+        n_segments = max(1, min(self.segments, size // self.min_segment_size))
+        if n_segments > 1 and not self._supports_ranges(url):
+            n_segments = 1
+        bounds = [size * i // n_segments for i in range(n_segments + 1)]
+        return [
+            {"start": bounds[i], "end": bounds[i + 1], "done": 0, "ranges": n_segments > 1}
+            for i in range(n_segments)
+        ]
+
+    def _supports_ranges(self, url: str) -> bool:
+        request = self._request(url, {"Range": "bytes=0-0"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status == 206
+        except (urllib.error.URLError, OSError):
+            return False
+
+    def _download_segment(
+        self, url: str, part_path: Path, segment: Dict, on_bytes, stop: threading.Event
+    ):
+        for attempt in range(self.retries + 1):
+            start = segment["start"] + segment["done"]
+            if start >= segment["end"]:
+                return
+            headers = {}
+            if segment["ranges"] or start > 0:
+                headers["Range"] = f"bytes={start}-{segment['end'] - 1}"
+            try:
+                request = self._request(url, headers)
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    if "Range" in headers and response.status != 206:
+                        raise DownloadError("The server does not support range requests")
+                    # Unbuffered, so the saved progress never counts bytes still in Python
+                    with open(part_path, "r+b", buffering=0) as f:
+                        f.seek(start)
+                        while start < segment["end"]:
+                            if self.cancelled.is_set() or stop.is_set():
+                                raise DownloadError("Download cancelled")
+                            chunk = response.read(min(self.chunk_size, segment["end"] - start))
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                            start += len(chunk)
+                            segment["done"] += len(chunk)
+                            on_bytes(len(chunk))
+                if start >= segment["end"]:
+                    return
+                raise DownloadError("The connection closed before the end of the file")
+            except (urllib.error.URLError, OSError, DownloadError) as e:
+                if self.cancelled.is_set() or stop.is_set() or attempt == self.retries:
+                    raise DownloadError(f"Download of {url} failed: {e}") from e
+                print(f"Retrying the download of {url} after an error: {e}")
+                time.sleep(2**attempt)
+
+    def _load_segments(self, part_path: Path, state_path: Path, size: int) -> Optional[List]:
+        if not part_path.exists() or not state_path.exists():
+            return None
+        try:
+            with open(state_path, "r") as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if state.get("size") != size or part_path.stat().st_size != size:
+            return None
+        print(f"Resuming the download of {part_path.name}")
+        return state["segments"]
+
+    def _save_segments(self, state_path: Path, size: int, segments: List[Dict]):
+        tmp_path = state_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"size": size, "segments": segments}, f)
+        os.replace(tmp_path, state_path)
+
+    def _file_sha256(self, path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(8 * 1024**2):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _request(self, url: str, headers: Optional[Dict] = None) -> urllib.request.Request:
+        headers = dict(headers or {})
+        try:
+            from huggingface_hub import get_token
+
+            token = get_token()
+        except ImportError:
+            token = None
+        if token and url.startswith(self.endpoint):
+            headers["Authorization"] = f"Bearer {token}"
+        headers["User-Agent"] = "llama-assistant"
+        return urllib.request.Request(url, headers=headers)
+
+    def _read_index(self) -> Dict:
+        if not self.index_file.exists():
+            return {}
+        try:
+            with open(self.index_file, "r") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def _update_index(self, model_id: str, entry: Dict):
+        with file_lock(self.models_dir / "index.lock"):
+            index = self._read_index()
+            index[model_id] = entry
+            tmp_path = self.index_file.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(index, f, indent=2)
+            os.replace(tmp_path, self.index_file)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="llama-assistant download", description="Download models ahead of their first use"
+    )
+    parser.add_argument(
+        "model_ids", nargs="*", help="Model IDs (default: the configured text and image models)"
+    )
+    parser.add_argument("--endpoint", default=DEFAULT_ENDPOINT)
+    parser.add_argument("--segments", type=int, default=4, help="Parallel range requests")
+    args = parser.parse_args(argv)
+
+    settings = config.load_settings()
+    model_ids = args.model_ids or [settings["text_model"], settings["multimodal_model"]]
+    manager = DownloadManager(endpoint=args.endpoint, segments=args.segments)
+    exit_code = 0
+    for model_id in model_ids:
+        model = registry.get(model_id)
+        if model is None or not model.is_online():
+            print(f"{model_id} is not an online model")
+            exit_code = 1
+            continue
+
+        start_time = time.perf_counter()
+
+        def show_progress(phase: str, done: int, total: int):
+            percent = done * 100 / total if total else 100
+            speed = done / max(time.perf_counter() - start_time, 1e-6) / 1024**2
+            print(f"\r{model_id}: {phase} {percent:5.1f}% ({speed:.1f} MiB/s)", end="", flush=True)
+
+        try:
+            entry = manager.ensure(
+                model_id, model.repo_id, model.filename, model.model_type, show_progress
+            )
+        except KeyboardInterrupt:
+            manager.cancel()
+            print("\nInterrupted, run the same command again to resume")
+            return 130
+        except DownloadError as e:
+            print(f"\n{model_id}: {e}")
+            exit_code = 1
+            continue
+        print(f"\n{model_id}: {entry['model_path']}")
+    return exit_code
@@ -0,0 +1,76 @@
+import threading
+import time
+from typing import List
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from llama_assistant.download_manager import DownloadError, DownloadManager
+from llama_assistant.model_registry import Model
+
+
+class DownloadThread(QThread):
+    """Downloads models in the background and reports the progress to the GUI"""
+
+    progress_signal = pyqtSignal(str, str, int, int)  # Model ID, phase, bytes done, total
+    finished_signal = pyqtSignal(str)
+    error_signal = pyqtSignal(str, str)
+    PROGRESS_INTERVAL = 0.25  # Seconds between progress updates
+
+    def __init__(self, models: List[Model]):
+        super().__init__()
+        self.pending = list(models)
+        self.lock = threading.Lock()
+        self.done = False
+        self.manager = DownloadManager()
+        self.last_progress = 0.0
+
+    def add_models(self, models: List[Model]) -> bool:
+        """Queue more models, False if the thread already finished and a new one is needed"""
+        with self.lock:
+            if self.done:
+                return False
+            queued = {m.model_id for m in self.pending}
+            self.pending.extend(m for m in models if m.model_id not in queued)
+            return True
+
+    def run(self):
+        try:
+            self.download_pending()
+        finally:
+            # Also when the thread dies, so that add_models asks for a new one
+            with self.lock:
+                self.done = True
+
+    def download_pending(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+                model = self.pending[0]
+            model_id = model.model_id
+
+            def on_progress(phase: str, done: int, total: int):
+                now = time.monotonic()
+                if phase == "downloading" and now - self.last_progress < self.PROGRESS_INTERVAL:
+                    return
+                self.last_progress = now
+                self.progress_signal.emit(model_id, phase, done, total)
+
+            try:
+                self.manager.ensure(
+                    model_id, model.repo_id, model.filename, model.model_type, on_progress
+                )
+            except Exception as e:
+                if self.manager.cancelled.is_set():
+                    return
+                if not isinstance(e, DownloadError):
+                    print(f"Unexpected error while downloading {model_id}: {e!r}")
+                self.error_signal.emit(model_id, str(e))
+            else:
+                self.finished_signal.emit(model_id)
+            with self.lock:
+                self.pending.remove(model)
+
+    def stop(self):
+        self.manager.cancel()
+        self.wait()
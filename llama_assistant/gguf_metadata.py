@@ -0,0 +1,83 @@
+import os
+import struct
+from functools import lru_cache
+from typing import Dict
+
+GGUF_MAGIC = b"GGUF"
+
+# GGUF value types with a fixed size, as struct formats
+SCALAR_FORMATS = {
+    0: "<B",  # uint8
+    1: "<b",  # int8
+    2: "<H",  # uint16
+    3: "<h",  # int16
+    4: "<I",  # uint32
+    5: "<i",  # int32
+    6: "<f",  # float32
+    7: "<?",  # bool
+    10: "<Q",  # uint64
+    11: "<q",  # int64
+    12: "<d",  # float64
+}
+STRING_TYPE = 8
+ARRAY_TYPE = 9
+
+
+def read_gguf_metadata(path: str) -> Dict:
+    """Scalar and string metadata of a GGUF file, read from its header without loading the
+    model. Arrays, like the tokenizer vocabulary, are skipped. Empty if the file can not be
+    read as GGUF."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    return dict(_read_gguf_metadata(str(path), stat.st_mtime_ns, stat.st_size))
+
+
+@lru_cache(maxsize=16)
+def _read_gguf_metadata(path: str, mtime_ns: int, size: int) -> Dict:
+    try:
+        with open(path, "rb") as f:
+            if f.read(4) != GGUF_MAGIC:
+                return {}
+            (version,) = struct.unpack("<I", f.read(4))
+            if version < 2:
+                return {}  # Version 1 used 32-bit counts, no longer produced by llama.cpp
+            _, kv_count = struct.unpack("<QQ", f.read(16))
+            metadata = {}
+            for _ in range(kv_count):
+                key = _read_string(f)
+                (value_type,) = struct.unpack("<I", f.read(4))
+                if value_type == ARRAY_TYPE:
+                    _skip_array(f)
+                else:
+                    metadata[key] = _read_value(f, value_type)
+            return metadata
+    except (OSError, struct.error, KeyError, UnicodeDecodeError) as e:
+        print(f"Failed to read GGUF metadata from {path}: {e}")
+        return {}
+
+
+def _read_string(f) -> str:
+    (length,) = struct.unpack("<Q", f.read(8))
+    return f.read(length).decode("utf-8")
+
+
+def _read_value(f, value_type: int):
+    if value_type == STRING_TYPE:
+        return _read_string(f)
+    value_format = SCALAR_FORMATS[value_type]
+    return struct.unpack(value_format, f.read(struct.calcsize(value_format)))[0]
+
+
+def _skip_array(f):
+    item_type, count = struct.unpack("<IQ", f.read(12))
+    if item_type == STRING_TYPE:
+        for _ in range(count):
+            (length,) = struct.unpack("<Q", f.read(8))
+            f.seek(length, os.SEEK_CUR)
+    elif item_type == ARRAY_TYPE:
+        for _ in range(count):
+            _skip_array(f)
+    else:
+        f.seek(count * struct.calcsize(SCALAR_FORMATS[item_type]), os.SEEK_CUR)
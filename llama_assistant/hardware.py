@@ -0,0 +1,102 @@
+import ctypes
+import os
+import subprocess
+import sys
+from typing import Dict
+
+
+def logical_core_count() -> int:
+    return os.cpu_count() or 1
+
+
+def physical_core_count() -> int:
+    """Number of physical cores, ignoring SMT siblings"""
+    try:
+        if sys.platform.startswith("linux"):
+            cores = set()
+            physical_id = core_id = None
+            with open("/proc/cpuinfo") as f:
+                for line in f:
+                    if line.startswith("physical id"):
+                        physical_id = line.split(":")[1].strip()
+                    elif line.startswith("core id"):
+                        core_id = line.split(":")[1].strip()
+                    elif not line.strip():
+                        if core_id is not None:
+                            cores.add((physical_id, core_id))
+                        physical_id = core_id = None
+            if core_id is not None:
+                cores.add((physical_id, core_id))
+            if cores:
+                return len(cores)
+        elif sys.platform == "darwin":
+            output = subprocess.check_output(["sysctl", "-n", "hw.physicalcpu"])
+            return int(output.strip())
+    except Exception as e:
+        print(f"Failed to read the physical core count: {e}")
+    return logical_core_count()
+
+
+def memory_info() -> Dict[str, int]:
+    """Total and available system memory in bytes"""
+    try:
+        if sys.platform.startswith("linux"):
+            meminfo = {}
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    key, value = line.split(":", 1)
+                    meminfo[key] = int(value.split()[0]) * 1024
+            return {
+                "total": meminfo["MemTotal"],
+                "available": meminfo.get("MemAvailable", meminfo["MemFree"]),
+            }
+        elif sys.platform == "win32":
+
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [
+                    ("dwLength", ctypes.c_ulong),
+                    ("dwMemoryLoad", ctypes.c_ulong),
+                    ("ullTotalPhys", ctypes.c_ulonglong),
+                    ("ullAvailPhys", ctypes.c_ulonglong),
+                    ("ullTotalPageFile", ctypes.c_ulonglong),
+                    ("ullAvailPageFile", ctypes.c_ulonglong),
+                    ("ullTotalVirtual", ctypes.c_ulonglong),
+                    ("ullAvailVirtual", ctypes.c_ulonglong),
+                    ("sullAvailExtendedVirtual", ctypes.c_ulonglong),
+                ]
+
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+            return {"total": status.ullTotalPhys, "available": status.ullAvailPhys}
+        elif sys.platform == "darwin":
+            total = int(subprocess.check_output(["sysctl", "-n", "hw.memsize"]).strip())
+            page_size = os.sysconf("SC_PAGE_SIZE")
+            vm_stat = subprocess.check_output(["vm_stat"]).decode()
+            free_pages = 0
+            for line in vm_stat.splitlines():
+                if line.startswith(("Pages free", "Pages inactive", "Pages speculative")):
+                    free_pages += int(line.split(":")[1].strip().rstrip("."))
+            return {"total": total, "available": free_pages * page_size}
+    except Exception as e:
+        print(f"Failed to read the system memory: {e}")
+    return {"total": 0, "available": 0}
+
+
+def default_runtime_profile() -> Dict:
+    """Runtime parameters for llama.cpp derived from the hardware of this machine"""
+    available_memory = memory_info()["available"]
+    profile = {
+        "n_ctx": 2048,
+        # Generation is memory bound and does not gain from SMT siblings, prompt
+        # evaluation is compute bound and does
+        "n_threads": physical_core_count(),
+        "n_threads_batch": logical_core_count(),
+        "n_batch": 512,
+        "use_mmap": True,
+        "use_mlock": False,
+    }
+    if 0 < available_memory < 4 * 1024**3:
+        # Halve the size of the K cache when the machine is short on memory
+        profile["type_k"] = "q8_0"
+    return profile
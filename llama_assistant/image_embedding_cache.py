@@ -0,0 +1,165 @@
+import ctypes
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from llama_cpp import llava_cpp
+
+from llama_assistant import config
+from llama_assistant.response_cache import file_fingerprint
+
+
+class CachedEmbedding:
+    """Image embedding of a vision encoder, as the llava_image_embed struct llama.cpp
+    evaluates. Embeddings computed by llava are freed by llava, embeddings read from
+    disk live in a numpy array."""
+
+    def __init__(self, embed, array: Optional[np.ndarray] = None):
+        self.embed = embed
+        self.array = array
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, n_image_pos: int) -> "CachedEmbedding":
+        embed = llava_cpp.llava_image_embed(
+            array.ctypes.data_as(ctypes.POINTER(ctypes.c_float)), n_image_pos
+        )
+        return cls(ctypes.pointer(embed), array)
+
+    @property
+    def n_image_pos(self) -> int:
+        return self.embed.contents.n_image_pos
+
+    def to_array(self, n_embd: int) -> np.ndarray:
+        if self.array is not None:
+            return self.array
+        return np.ctypeslib.as_array(self.embed.contents.embed, shape=(self.n_image_pos * n_embd,))
+
+    def free(self):
+        if self.array is None:
+            llava_cpp.llava_image_embed_free(self.embed)
+        self.embed = None
+        self.array = None
+
+
+class ImageEmbeddingCache:
+    """Image embeddings of the llava chat handlers keyed by the mmproj file and the image.
+
+    The chat handlers only remember the embedding of the last image and run the vision
+    encoder again for any other one. With the cache installed, questions about an image
+    that was seen before skip the encoder, also across models that share an mmproj file.
+    Embeddings are kept in memory with LRU eviction and, if enabled, on disk.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = config.image_embedding_cache_dir,
+        memory_capacity: int = 512 * 1024**2,
+        disk_capacity: int = 2 * 1024**3,
+        disk_enabled: bool = False,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.memory_capacity = memory_capacity
+        self.disk_capacity = disk_capacity
+        self.disk_enabled = disk_enabled
+        self.memory: "OrderedDict[Tuple[str, str], Tuple[CachedEmbedding, int]]" = OrderedDict()
+        # The embedding each handler is evaluating must not be freed under it
+        self.in_use: Dict[int, Tuple[str, str]] = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+    def install(self, chat_handler, n_embd: int):
+        """Route the image embeddings of a llava chat handler through the cache"""
+        encode = chat_handler._embed_image_bytes
+        clip_hash = file_fingerprint(chat_handler.clip_model_path)
+
+        def embed_image_bytes(image_bytes: bytes, n_threads_batch: int = 1):
+            key = (clip_hash, hashlib.sha256(image_bytes).hexdigest())
+            with self.lock:
+                cached = self._get(key, n_embd)
+                if cached is None:
+                    self.stats["misses"] += 1
+                    cached = CachedEmbedding(encode(image_bytes, n_threads_batch))
+                    # The cache frees the embedding from now on, not the handler
+                    chat_handler._last_image_embed = None
+                    chat_handler._last_image_hash = None
+                    self._put(key, cached, n_embd)
+                self.in_use[id(chat_handler)] = key
+                return cached.embed
+
+        chat_handler._embed_image_bytes = embed_image_bytes
+
+    @property
+    def memory_size(self) -> int:
+        return sum(size for _, size in self.memory.values())
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return {**self.stats, "entries": len(self.memory), "memory_size": self.memory_size}
+
+    def clear_memory(self):
+        with self.lock:
+            for key in list(self.memory):
+                if key not in self.in_use.values():
+                    self.memory.pop(key)[0].free()
+
+    def _get(self, key: Tuple[str, str], n_embd: int) -> Optional[CachedEmbedding]:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.stats["hits"] += 1
+            return self.memory[key][0]
+        if not self.disk_enabled:
+            return None
+
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            array = np.fromfile(path, dtype=np.float32)
+        except OSError as e:
+            print(f"Failed to read image embedding cache entry {path}: {e}")
+            return None
+        if array.size == 0 or array.size % n_embd:
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)  # Disk eviction is ordered by last use
+        cached = CachedEmbedding.from_array(array, array.size // n_embd)
+        self._put_memory(key, cached, array.nbytes)
+        self.stats["disk_hits"] += 1
+        return cached
+
+    def _put(self, key: Tuple[str, str], cached: CachedEmbedding, n_embd: int):
+        array = cached.to_array(n_embd)
+        self._put_memory(key, cached, array.nbytes)
+        if not self.disk_enabled:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        array.tofile(tmp_path)
+        os.replace(tmp_path, path)
+        self._evict_disk()
+
+    def _put_memory(self, key: Tuple[str, str], cached: CachedEmbedding, size: int):
+        self.memory[key] = (cached, size)
+        self.memory.move_to_end(key)
+        in_use = set(self.in_use.values()) | {key}
+        for old_key in list(self.memory):
+            if self.memory_size <= self.memory_capacity:
+                break
+            if old_key not in in_use:
+                self.memory.pop(old_key)[0].free()
+
+    def _path(self, key: Tuple[str, str]) -> Path:
+        return self.cache_dir / f"{hashlib.sha256(''.join(key).encode()).hexdigest()}.f32"
+
+    def _evict_disk(self):
+        files = sorted(self.cache_dir.glob("*.f32"), key=lambda p: p.stat().st_mtime)
+        total_size = sum(p.stat().st_size for p in files)
+        while files and total_size > self.disk_capacity:
+            oldest = files.pop(0)
+            total_size -= oldest.stat().st_size
+            oldest.unlink(missing_ok=True)
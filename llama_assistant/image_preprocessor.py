@@ -0,0 +1,106 @@
+import base64
+from typing import Optional, Tuple
+
+# First bytes of the image formats that can be dropped into the chat
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+]
+
+# Formats the vision encoders of llama.cpp decode themselves
+ENCODER_FORMATS = {"image/png", "image/jpeg"}
+
+# Longest image side that the vision encoder of a model still sees, larger images are
+# scaled down to it by the encoder anyway. Matched against the model ID in this order.
+VISION_RESOLUTIONS = [
+    ("moondream2", 378),
+    ("MiniCPM", 1344),  # Up to 3x3 slices of 448 pixels
+    ("llava-v1.5", 336),
+    ("llava-v1.6", 672),  # Grids of 336 pixel tiles up to 672x672
+]
+DEFAULT_VISION_RESOLUTION = 672
+
+
+def detect_image_format(header: bytes) -> Optional[str]:
+    """MIME type of an image from its first bytes, None if the format is unknown"""
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return mime_type
+    return None
+
+
+def get_vision_resolution(model_id: Optional[str]) -> int:
+    for pattern, resolution in VISION_RESOLUTIONS:
+        if model_id and pattern in model_id:
+            return resolution
+    return DEFAULT_VISION_RESOLUTION
+
+
+def preprocess_image(
+    file_path: str, max_side: int = DEFAULT_VISION_RESOLUTION, quality: int = 90
+) -> Tuple[bytes, str]:
+    """Image bytes ready for the vision encoder and their MIME type.
+
+    JPEG and PNG files that are small enough are passed through as they are. Other
+    images are decoded at the target size, which the JPEG decoder does without
+    building the full resolution image, and encoded as JPEG.
+    """
+    # Imported here so that the headless commands can use this module without PyQt5
+    from PyQt5.QtCore import QBuffer, QByteArray, QIODevice, QSize, Qt
+    from PyQt5.QtGui import QImage, QImageIOHandler, QImageReader, QPainter
+
+    with open(file_path, "rb") as f:
+        mime_type = detect_image_format(f.read(16))
+
+    reader = QImageReader(file_path)
+    reader.setAutoTransform(True)  # Rotate as the EXIF orientation says
+    size = reader.size()
+    if not size.isValid():
+        raise ValueError(f"Can not read the image {file_path}: {reader.errorString()}")
+    # The encoders do not read the EXIF orientation
+    transformed = reader.transformation() != QImageIOHandler.Transformation.TransformationNone
+    if (
+        mime_type in ENCODER_FORMATS
+        and max(size.width(), size.height()) <= max_side
+        and not transformed
+    ):
+        with open(file_path, "rb") as f:
+            return f.read(), mime_type
+
+    if max(size.width(), size.height()) > max_side:
+        # Both sizes are before the rotation, which is applied after decoding
+        reader.setScaledSize(
+            size.scaled(QSize(max_side, max_side), Qt.AspectRatioMode.KeepAspectRatio)
+        )
+    image = reader.read()
+    if image.isNull():
+        raise ValueError(f"Can not read the image {file_path}: {reader.errorString()}")
+
+    if image.hasAlphaChannel():
+        # JPEG has no alpha channel, put transparent images on white
+        background = QImage(image.size(), QImage.Format.Format_RGB32)
+        background.fill(Qt.GlobalColor.white)
+        painter = QPainter(background)
+        painter.drawImage(0, 0, image)
+        painter.end()
+        image = background
+
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+    image.save(buffer, "JPEG", quality)
+    buffer.close()
+    return data.data(), "image/jpeg"
+
+
+def image_to_data_uri(file_path: str, model_id: Optional[str] = None) -> str:
+    """Data URI of an image preprocessed for the vision encoder of a model"""
+    image_bytes, mime_type = preprocess_image(file_path, get_vision_resolution(model_id))
+    return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('ascii')}"
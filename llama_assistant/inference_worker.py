@@ -0,0 +1,352 @@
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, List, Optional, Tuple
+
+from llama_assistant.chat_session import ChatSession
+from llama_assistant.image_preprocessor import image_to_data_uri
+
+
+class TokenRing:
+    """Single-producer, single-consumer ring buffer of text chunks in shared memory.
+
+    The worker appends (request id, text) records and the GUI process reads them, so
+    streamed tokens never go through a pipe or get pickled. Each side only writes its
+    own position in the header.
+    """
+
+    HEADER = struct.Struct("QQ")  # Write position, read position
+    RECORD = struct.Struct("II")  # Request ID, payload size
+
+    def __init__(self, name: Optional[str] = None, size: int = 1024**2, track: bool = True):
+        if name is None:
+            self.shm = SharedMemory(create=True, size=self.HEADER.size + size)
+            self.HEADER.pack_into(self.shm.buf, 0, 0, 0)
+        else:
+            self.shm = SharedMemory(name=name)
+            if not track and os.name == "posix":
+                # The ring belongs to the process that created it. Without this, the
+                # resource tracker of an unrelated process (the daemon) unlinks it on exit
+                from multiprocessing import resource_tracker
+
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.name = self.shm.name
+        self.capacity = self.shm.size - self.HEADER.size
+
+    def write(self, request_id: int, text: str, should_abort: Callable[[], bool]) -> bool:
+        """Append a chunk, waiting for the reader while the ring is full"""
+        # UTF-8 takes at most 4 bytes per character, so each piece fits in the ring
+        max_chars = (self.capacity - self.RECORD.size) // 8
+        for start in range(0, len(text), max_chars):
+            data = text[start : start + max_chars].encode("utf-8")
+            if not self._write_record(request_id, data, should_abort):
+                return False
+        return True
+
+    def read(self) -> List[Tuple[int, str]]:
+        write_pos, read_pos = self.HEADER.unpack_from(self.shm.buf, 0)
+        records = []
+        while read_pos < write_pos:
+            request_id, size = self.RECORD.unpack(self._read(read_pos, self.RECORD.size))
+            data = self._read(read_pos + self.RECORD.size, size)
+            records.append((request_id, data.decode("utf-8")))
+            read_pos += self.RECORD.size + size
+        struct.pack_into("Q", self.shm.buf, 8, read_pos)
+        return records
+
+    def reset(self):
+        self.HEADER.pack_into(self.shm.buf, 0, 0, 0)
+
+    def close(self, unlink: bool = False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+    def _write_record(self, request_id: int, data: bytes, should_abort) -> bool:
+        size = self.RECORD.size + len(data)
+        while True:
+            write_pos, read_pos = self.HEADER.unpack_from(self.shm.buf, 0)
+            if self.capacity - (write_pos - read_pos) >= size:
+                break
+            if should_abort():
+                return False
+            time.sleep(0.001)
+        self._write(write_pos, self.RECORD.pack(request_id, len(data)) + data)
+        # Publish the record only after its bytes are in place
+        struct.pack_into("Q", self.shm.buf, 0, write_pos + size)
+        return True
+
+    def _write(self, pos: int, data: bytes):
+        offset = self.HEADER.size + pos % self.capacity
+        first = min(len(data), self.shm.size - offset)
+        self.shm.buf[offset : offset + first] = data[:first]
+        self.shm.buf[self.HEADER.size : self.HEADER.size + len(data) - first] = data[first:]
+
+    def _read(self, pos: int, size: int) -> bytes:
+        offset = self.HEADER.size + pos % self.capacity
+        first = min(size, self.shm.size - offset)
+        data = bytes(self.shm.buf[offset : offset + first])
+        return data + bytes(self.shm.buf[self.HEADER.size : self.HEADER.size + size - first])
+
+
+class InferenceRequest:
+    def __init__(
+        self,
+        client,
+        request_id,
+        model,
+        prompt=None,
+        image=None,
+        prefix=None,
+        session_id=None,
+        task=None,
+        warm_up=False,
+    ):
+        self.client = client
+        self.request_id = request_id
+        self.model = model
+        self.prompt = prompt
+        self.image = image
+        self.prefix = prefix
+        self.session_id = session_id
+        self.task = task
+        self.warm_up = warm_up
+        self.cancelled = threading.Event()
+
+
+class WorkerClient:
+    """Connection of one GUI or CLI process and the ring its tokens are written to"""
+
+    def __init__(self, conn, ring: TokenRing):
+        self.conn = conn
+        self.ring = ring
+        self.send_lock = threading.Lock()
+
+    def send(self, *event):
+        with self.send_lock:
+            try:
+                self.conn.send(event)
+            except (EOFError, OSError):
+                pass
+
+
+class WorkerServer:
+    """Owns the model pool and executes the requests of its clients one at a time.
+
+    Each client's commands are read on their own thread, generation runs on a single
+    thread so that a cancel command can stop it at the next token. The inference
+    worker serves the GUI that started it, the daemon serves every client that
+    connects.
+    """
+
+    def __init__(self, max_sessions: int = 8):
+        from llama_assistant.model_handler import handler as model_handler
+
+        self.model_handler = model_handler
+        self.requests = queue.Queue()
+        self.current_request: Optional[InferenceRequest] = None
+        self.sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self.max_sessions = max_sessions
+        self.generator = threading.Thread(target=self._generate_loop, daemon=True)
+        self.generator.start()
+
+    def serve_client(self, client: WorkerClient):
+        """Handle the commands of a client until it disconnects"""
+        while True:
+            try:
+                command, *args = client.conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if command == "generate":
+                request_id, model, kwargs = args
+                self.requests.put(InferenceRequest(client, request_id, model, **kwargs))
+            elif command == "warm_up":
+                self.requests.put(InferenceRequest(client, *args, warm_up=True))
+            elif command == "cancel":
+                self._cancel_all(client)
+            elif command == "settings":
+                self.model_handler.apply_settings(args[0])
+        self._cancel_all(client)
+
+    def stop(self):
+        with self.requests.mutex:
+            pending = list(self.requests.queue)
+        for request in pending + [self.current_request]:
+            if request is not None:
+                request.cancelled.set()
+        self.requests.put(None)
+        self.generator.join(timeout=5)
+
+    def _cancel_all(self, client: WorkerClient):
+        # Requests of other clients keep their place in the queue
+        with self.requests.mutex:
+            pending = list(self.requests.queue)
+        for request in pending + [self.current_request]:
+            if request is not None and request.client is client:
+                request.cancelled.set()
+
+    def _get_session(self, session_id: Optional[str], model_id: str) -> Optional[ChatSession]:
+        if session_id is None:
+            return None
+        session = self.sessions.get(session_id)
+        if session is None or session.model_id != model_id:
+            session = ChatSession(model_id, session_id=session_id)
+            self.sessions[session_id] = session
+        self.sessions.move_to_end(session_id)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return session
+
+    def _generate_loop(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            if request.cancelled.is_set():
+                continue
+
+            self.current_request = request
+            try:
+                if request.warm_up:
+                    self._process_warm_up(request)
+                else:
+                    self._process_request(request)
+            except Exception as e:
+                traceback.print_exc()
+                request.client.send("error", f"An error occurred: {str(e)}")
+                if not request.warm_up:
+                    request.client.send("finished", request.request_id)
+            finally:
+                self.current_request = None
+
+    def _process_warm_up(self, request: InferenceRequest):
+        if self.model_handler.warm_up(request.model):
+            request.client.send("model_ready", request.model)
+        else:
+            request.client.send("error", f"Failed to load model: {request.model}")
+
+    def _process_request(self, request: InferenceRequest):
+        image = None
+        if request.image:
+            # Decoded here rather than in the GUI, at the size the vision encoder uses
+            image = image_to_data_uri(request.image, request.model)
+        output = self.model_handler.chat_completion(
+            request.model,
+            request.prompt,
+            image=image,
+            stream=True,
+            prefix=request.prefix,
+            session=self._get_session(request.session_id, request.model),
+            task=request.task,
+        )
+        ring = request.client.ring
+        for chunk in output:
+            if request.cancelled.is_set():
+                # Closing the stream stops llama.cpp before it evaluates another token
+                output.close()
+                request.client.send("cancelled", request.request_id)
+                return
+            delta = chunk["choices"][0]["delta"]
+            if "content" in delta:
+                ring.write(request.request_id, delta["content"], request.cancelled.is_set)
+        # Tokens are in the ring before this event arrives
+        request.client.send("finished", request.request_id)
+
+
+def worker_main(conn, ring_name: str):
+    ring = TokenRing(name=ring_name)
+    server = WorkerServer()
+    try:
+        # The worker lives as long as the connection to the GUI that started it
+        server.serve_client(WorkerClient(conn, ring))
+    finally:
+        server.stop()
+        ring.close()
+
+
+class InferenceWorker:
+    """Connection to the daemon if one is running, otherwise to a worker process of our own"""
+
+    def __init__(self):
+        # Forking a process that runs Qt is unsafe, always start a fresh interpreter
+        self.context = multiprocessing.get_context("spawn")
+        self.ring = TokenRing()
+        self.process = None
+        self.conn = None
+        self.disconnected = False
+        self.send_lock = threading.Lock()
+
+    def start(self):
+        from llama_assistant import daemon
+
+        self.ring.reset()
+        self.disconnected = False
+        self.conn = daemon.connect(self.ring.name)
+        if self.conn is not None:
+            return
+
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=worker_main, args=(child_conn, self.ring.name), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def is_alive(self) -> bool:
+        if self.process is None:
+            return self.conn is not None and not self.disconnected
+        return self.process.is_alive()
+
+    def is_attached_to_daemon(self) -> bool:
+        return self.conn is not None and self.process is None
+
+    def send(self, *command) -> bool:
+        with self.send_lock:
+            if self.conn is None:
+                return False
+            try:
+                self.conn.send(command)
+                return True
+            except (EOFError, OSError):
+                return False
+
+    def poll(self, timeout: float) -> Optional[Tuple]:
+        """Next event from the worker, or None after the timeout"""
+        try:
+            if self.conn.poll(timeout):
+                return self.conn.recv()
+        except (EOFError, OSError):
+            # The worker or the daemon is gone
+            self.disconnected = True
+            time.sleep(timeout)
+        return None
+
+    def read_tokens(self) -> List[Tuple[int, str]]:
+        return self.ring.read()
+
+    def stop(self, timeout: float = 5):
+        if self.conn is None:
+            return
+        # The worker exits when its connection closes, the daemon only drops this client
+        self.conn.close()
+        if self.process is not None:
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        self.process = None
+        self.conn = None
+
+    def close(self):
+        self.stop()
+        self.ring.close(unlink=True)
+
+    def get_exit_code(self) -> Optional[int]:
+        return self.process.exitcode if self.process is not None else None
@@ -1,8 +1,8 @@
 import json
 import copy
+import html
 import time
 import traceback
-import markdown
 
 from PyQt5.QtWidgets import (
     QApplication,
@@ -13,17 +13,13 @@ from PyQt5.QtWidgets import (
     QSystemTrayIcon,
 )
 from PyQt5.QtCore import (
-    Qt,
     QPoint,
     QTimer,
 )
 from PyQt5.QtGui import (
     QPixmap,
-    QPainter,
     QDragEnterEvent,
     QDropEvent,
-    QBitmap,
-    QTextCursor,
 )
 
 from llama_assistant import config
@@ -31,8 +27,16 @@ from llama_assistant.wake_word_detector import WakeWordDetector
 from llama_assistant.global_hotkey import GlobalHotkey
 from llama_assistant.setting_dialog import SettingsDialog
 from llama_assistant.speech_recognition_thread import SpeechRecognitionThread
-from llama_assistant.utils import image_to_base64_data_uri
 from llama_assistant.processing_thread import ProcessingThread
+from llama_assistant.chat_session import ChatSession
+from llama_assistant.chat_history import ChatHistory
+from llama_assistant.chat_renderer import RENDER_FPS, ChatRenderer
+from llama_assistant.conversation_store import MATCH_END, MATCH_START, ConversationStore
+from llama_assistant.download_manager import DownloadManager
+from llama_assistant.download_thread import DownloadThread
+from llama_assistant.model_registry import registry
+from llama_assistant.model_registry_watcher import ModelRegistryWatcher
+from llama_assistant.thumbnail_loader import ThumbnailLoader
 from llama_assistant.ui_manager import UIManager
 from llama_assistant.tray_manager import TrayManager
 
@@ -41,6 +45,7 @@ class LlamaAssistant(QMainWindow):
     def __init__(self):
         super().__init__()
         self.wake_word_detector = None
+        self.processing_thread = ProcessingThread()
         self.load_settings()
         self.ui_manager = UIManager(self)
         self.tray_manager = TrayManager(self)
@@ -50,10 +55,36 @@ class LlamaAssistant(QMainWindow):
         self.speech_thread = None
         self.is_listening = False
         self.image_label = None
+        self.thumbnail_loader = ThumbnailLoader(parent=self)
+        self.thumbnail_loader.thumbnail_ready.connect(self.on_thumbnail_ready)
         self.current_text_model = self.settings.get("text_model")
         self.current_multimodal_model = self.settings.get("multimodal_model")
-        self.processing_thread = None
+        self.processing_thread.finished_signal.connect(self.on_processing_finished)
+        self.processing_thread.model_ready_signal.connect(self.on_model_ready)
+        self.processing_thread.error_signal.connect(self.on_model_error)
+        self.processing_thread.start()
+        self.download_manager = DownloadManager()
+        self.download_thread = None
+        self.model_registry_watcher = ModelRegistryWatcher(registry, self)
+        self.current_request_id = None
+        self.chat_session = None
         self.response_start_position = 0
+        self.chat_renderer = ChatRenderer(self.ui_manager.chat_box)
+        self.chat_history = ChatHistory(
+            self.ui_manager.chat_box,
+            self.settings.get(
+                "chat_window_messages", config.DEFAULT_SETTINGS["chat_window_messages"]
+            ),
+        )
+        self.conversation_store = None
+        if self.settings.get("conversation_history", True):
+            self.conversation_store = ConversationStore()
+        self.current_exchange = None
+        # Streamed tokens are drawn in batches at a bounded frame rate
+        self.render_timer = QTimer(self)
+        self.render_timer.setInterval(1000 // RENDER_FPS)
+        self.render_timer.timeout.connect(self.flush_tokens)
+        self.preload_model()
 
     def tray_icon_activated(self, reason):
         if reason == QSystemTrayIcon.ActivationReason.Trigger:
@@ -92,6 +123,7 @@ class LlamaAssistant(QMainWindow):
             self.deinit_wake_word_detector()
         self.current_text_model = self.settings.get("text_model")
         self.current_multimodal_model = self.settings.get("multimodal_model")
+        self.processing_thread.apply_settings(self.settings)
 
     def setup_global_shortcut(self):
         try:
@@ -101,17 +133,19 @@ class LlamaAssistant(QMainWindow):
             try:
                 self.global_hotkey = GlobalHotkey(self.settings["shortcut"])
                 self.global_hotkey.activated.connect(self.toggle_visibility)
+                self.global_hotkey.activated.connect(self.preload_model)
             except Exception as e:
                 print(f"Error setting up global shortcut: {e}")
                 # Fallback to default shortcut if there's an error
                 self.global_hotkey = GlobalHotkey(config.DEFAULT_LAUNCH_SHORTCUT)
                 self.global_hotkey.activated.connect(self.toggle_visibility)
+                self.global_hotkey.activated.connect(self.preload_model)
         except Exception as e:
             print(f"Error setting up global shortcut: {e}")
             traceback.print_exc()
 
     def open_settings(self):
-        dialog = SettingsDialog(self)
+        dialog = SettingsDialog(self, self.model_registry_watcher)
         if dialog.exec():
             new_settings = dialog.get_settings()
             old_shortcut = self.settings["shortcut"]
@@ -119,6 +153,7 @@ class LlamaAssistant(QMainWindow):
             self.save_settings()
             self.load_settings()
             self.ui_manager.update_styles()
+            self.preload_model()
 
             if old_shortcut != self.settings["shortcut"]:
                 msg = QMessageBox()
@@ -150,6 +185,74 @@ class LlamaAssistant(QMainWindow):
         with open(config.settings_file, "w") as f:
             json.dump(self.settings, f)
 
+    def preload_model(self):
+        # Online models are fetched here with progress, not inside the first request.
+        # Called on every hotkey press, so models on disk only cost an index lookup.
+        missing = [
+            model
+            for model in map(registry.get, (self.current_text_model, self.current_multimodal_model))
+            if model is not None and model.is_online() and not self.is_downloaded(model)
+        ]
+        if missing:
+            self.download_models(missing)
+        if any(model.model_id == self.current_text_model for model in missing):
+            return  # Preloaded when its download finishes
+        # Answered right away by the worker when the model is already loaded
+        self.set_model_status("Loading model...")
+        self.processing_thread.preload(self.current_text_model)
+
+    def is_downloaded(self, model):
+        files = self.download_manager.get_local_files(model.model_id, model.repo_id, model.filename)
+        return files is not None
+
+    def download_models(self, models):
+        # A running download is left alone, the models it does not have yet are queued to it
+        if self.download_thread is not None and self.download_thread.add_models(models):
+            return
+        if self.download_thread is not None:
+            self.download_thread.wait()
+        self.download_thread = DownloadThread(models)
+        self.download_thread.progress_signal.connect(self.on_download_progress)
+        self.download_thread.finished_signal.connect(self.on_download_finished)
+        self.download_thread.error_signal.connect(self.on_download_error)
+        self.download_thread.start()
+
+    def on_download_progress(self, model_id, phase, done, total):
+        if phase == "verifying":
+            status = f"Verifying {model_id}..."
+        elif total > 0:
+            status = f"Downloading {model_id} {done * 100 // total}%"
+        else:
+            return
+        if model_id == self.current_text_model:
+            self.set_model_status(status)
+        else:
+            # The multimodal model downloads in the background, the label stays with the text model
+            self.tray_manager.tray_icon.setToolTip(f"Llama Assistant - {status}")
+
+    def on_download_finished(self, model_id):
+        if model_id == self.current_text_model:
+            self.set_model_status("Loading model...")
+            self.processing_thread.preload(model_id)
+        else:
+            self.set_model_status(self.ui_manager.model_status_label.text())
+
+    def on_download_error(self, model_id, error_message):
+        print(f"Failed to download {model_id}: {error_message}")
+        self.set_model_status("Download failed")
+
+    def on_model_ready(self, model_id):
+        if model_id == self.current_text_model:
+            self.set_model_status("● Model ready")
+
+    def on_model_error(self, error_message):
+        print(error_message)
+        self.set_model_status("Model error")
+
+    def set_model_status(self, status):
+        self.ui_manager.model_status_label.setText(status)
+        self.tray_manager.tray_icon.setToolTip(f"Llama Assistant - {status}")
+
     def toggle_visibility(self):
         if self.isVisible():
             self.hide()
@@ -170,6 +273,10 @@ class LlamaAssistant(QMainWindow):
             self.remove_image_thumbnail()
             return
 
+        if message.startswith("/search"):
+            self.show_search_results(message[len("/search") :].strip())
+            return
+
         self.last_response = ""
 
         if self.dropped_image:
@@ -188,60 +295,139 @@ class LlamaAssistant(QMainWindow):
         self.process_text(message, task)
 
     def process_text(self, message, task="chat"):
+        self.cancel_processing()
         if task != "chat":
             self.clear_chat()
         self.show_chat_box()
-        if task == "chat":
-            prompt = message + " \n" + "Generate a short and simple response."
-        elif task == "Summarize":
-            prompt = f"Summarize the following text: {message}"
-        elif task == "Rephrase":
-            prompt = f"Rephrase the following text {message}"
-        elif task == "Fix Grammar":
-            prompt = f"Fix the grammar in the following text:\n {message}"
-        elif task == "Brainstorm":
-            prompt = f"Brainstorm ideas related to: {message}"
-        elif task == "Write Email":
-            prompt = f"Write an email about: {message}"
+        prompt, prefix = config.get_task_prompt(task, message)
 
+        self.chat_history.begin_message()
         self.ui_manager.chat_box.append(f'<span style="color: #aaa;"><b>You:</b></span> {message}')
         self.ui_manager.chat_box.append(f'<span style="color: #aaa;"><b>AI ({task}):</b></span> ')
+        self.chat_renderer.begin_response()
 
-        self.processing_thread = ProcessingThread(self.current_text_model, prompt)
-        self.processing_thread.update_signal.connect(self.update_chat_box)
-        self.processing_thread.finished_signal.connect(self.on_processing_finished)
-        self.processing_thread.start()
+        session = None
+        if task == "chat":
+            if self.chat_session is None or self.chat_session.model_id != self.current_text_model:
+                self.chat_session = ChatSession(self.current_text_model)
+            session = self.chat_session
+
+        self.current_request_id = self.processing_thread.submit(
+            self.current_text_model, prompt, prefix=prefix, session=session, task=task
+        )
+        self.current_exchange = {
+            "prompt": message,
+            "session_id": session.session_id if session is not None else None,
+            "task": task,
+            "model_id": self.current_text_model,
+        }
+        self.render_timer.start()
 
     def process_image_with_prompt(self, image_path, prompt):
+        self.cancel_processing()
         self.show_chat_box()
+        self.chat_history.begin_message()
         self.ui_manager.chat_box.append(
             f'<span style="color: #aaa;"><b>You:</b></span> [Uploaded an image: {image_path}]'
         )
         self.ui_manager.chat_box.append(f'<span style="color: #aaa;"><b>You:</b></span> {prompt}')
         self.ui_manager.chat_box.append('<span style="color: #aaa;"><b>AI:</b></span> ')
+        self.chat_renderer.begin_response()
 
-        image = image_to_base64_data_uri(image_path)
-        self.processing_thread = ProcessingThread(
-            self.current_multimodal_model, prompt, image=image
-        )
-        self.processing_thread.update_signal.connect(self.update_chat_box)
-        self.processing_thread.finished_signal.connect(self.on_processing_finished)
-        self.processing_thread.start()
-
-    def update_chat_box(self, text):
-        cursor = self.ui_manager.chat_box.textCursor()
-        cursor.movePosition(QTextCursor.MoveOperation.End)
-        self.ui_manager.chat_box.setTextCursor(cursor)
-        cursor.insertText(text)
-        self.ui_manager.chat_box.verticalScrollBar().setValue(
-            self.ui_manager.chat_box.verticalScrollBar().maximum()
+        # The worker reads and scales the image for the vision encoder of the model
+        self.current_request_id = self.processing_thread.submit(
+            self.current_multimodal_model, prompt, image=image_path, task="image"
         )
+        self.current_exchange = {
+            "prompt": f"[Image: {image_path}] {prompt}",
+            "task": "image",
+            "model_id": self.current_multimodal_model,
+        }
+        self.render_timer.start()
+
+    def flush_tokens(self):
+        for request_id, text in self.processing_thread.take_tokens():
+            self.update_chat_box(request_id, text)
+        # Draws text that a previous frame held back to stay within the render budget
+        self.chat_renderer.refresh()
+
+    def update_chat_box(self, request_id, text):
+        # Tokens of a cancelled request can still be in the buffer
+        if request_id != self.current_request_id:
+            return
+        self.chat_renderer.append_text(text)
         self.last_response += text
 
-    def on_processing_finished(self):
+    def on_processing_finished(self, request_id):
+        if request_id != self.current_request_id:
+            return
+        self.flush_tokens()
+        self.render_timer.stop()
+        self.chat_renderer.finish_response()
+        self.save_exchange()
+        self.current_request_id = None
         self.response_start_position = 0
         self.ui_manager.chat_box.append("")
 
+    def cancel_processing(self):
+        self.render_timer.stop()
+        if self.current_request_id is not None:
+            self.flush_tokens()
+            self.chat_renderer.finish_response()
+            self.save_exchange()
+            self.ui_manager.chat_box.append('<span style="color: #aaa;"><i>Stopped</i></span>')
+            self.ui_manager.chat_box.append("")
+            self.current_request_id = None
+        self.processing_thread.cancel()
+
+    def save_exchange(self):
+        if self.conversation_store is not None and self.current_exchange is not None:
+            self.conversation_store.add_exchange(
+                response=self.last_response, **self.current_exchange
+            )
+        self.current_exchange = None
+
+    def show_search_results(self, query):
+        self.show_chat_box()
+        self.chat_history.begin_message()
+        self.ui_manager.chat_box.append(
+            f'<span style="color: #aaa;"><b>Search:</b></span> {html.escape(query)}'
+        )
+        if self.conversation_store is None:
+            self.ui_manager.chat_box.append(
+                '<span style="color: #aaa;"><i>Conversation history is turned off</i></span>'
+            )
+            return
+        # Include the exchanges that are still queued for writing
+        self.conversation_store.flush()
+        start_time = time.perf_counter()
+        results = self.conversation_store.search(query)
+        elapsed = time.perf_counter() - start_time
+
+        def highlight(text):
+            text = html.escape(" ".join(text.split()))
+            return text.replace(MATCH_START, "<b>").replace(MATCH_END, "</b>")
+
+        for result in results:
+            created = time.strftime("%Y-%m-%d %H:%M", time.localtime(result["created"]))
+            self.ui_manager.chat_box.append(
+                f'<span style="color: #aaa;">{created} ({result["task"] or "chat"})</span><br>'
+                f'<span style="color: #aaa;"><b>You:</b></span> {highlight(result["prompt"])}<br>'
+                f'<span style="color: #aaa;"><b>AI:</b></span> {highlight(result["response"])}'
+            )
+        self.ui_manager.chat_box.append(
+            f'<span style="color: #aaa;"><i>{len(results)} results in '
+            f"{elapsed * 1000:.0f} ms</i></span>"
+        )
+        self.ui_manager.chat_box.append("")
+        self.chat_renderer.scroll_to_bottom()
+
+    def on_escape(self):
+        if self.processing_thread.is_busy():
+            self.cancel_processing()
+        else:
+            self.hide()
+
     def show_chat_box(self):
         if self.ui_manager.scroll_area.isHidden():
             self.ui_manager.scroll_area.show()
@@ -259,8 +445,10 @@ class LlamaAssistant(QMainWindow):
             clipboard.setText(self.last_response)
 
     def clear_chat(self):
-        self.ui_manager.chat_box.clear()
+        self.cancel_processing()
+        self.chat_history.clear()
         self.last_response = ""
+        self.chat_session = None
         self.ui_manager.scroll_area.hide()
         self.ui_manager.input_field.clear()
         self.ui_manager.input_field.setFocus()
@@ -280,10 +468,20 @@ class LlamaAssistant(QMainWindow):
             if file_path.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp")):
                 self.dropped_image = file_path
                 self.ui_manager.input_field.setPlaceholderText("Enter a prompt for the image...")
-                self.show_image_thumbnail(file_path)
+                # Decoded on a worker thread, the window stays responsive for large photos
+                self.thumbnail_loader.request(file_path)
                 break
 
-    def show_image_thumbnail(self, image_path):
+    def on_thumbnail_ready(self, image_path, thumbnail):
+        # Another image may have been dropped or the image removed in the meantime
+        if image_path != self.dropped_image:
+            return
+        if thumbnail.isNull():
+            print(f"Failed to read the image: {image_path}")
+            return
+        self.show_image_thumbnail(thumbnail)
+
+    def show_image_thumbnail(self, thumbnail):
         if self.image_label is None:
             self.image_label = QLabel(self)
             self.image_label.setFixedSize(80, 80)
@@ -314,28 +512,7 @@ class LlamaAssistant(QMainWindow):
             remove_button.move(60, 0)
             remove_button.clicked.connect(self.remove_image_thumbnail)
 
-        pixmap = QPixmap(image_path)
-        scaled_pixmap = pixmap.scaled(
-            80,
-            80,
-            Qt.AspectRatioMode.KeepAspectRatio,
-            Qt.TransformationMode.SmoothTransformation,
-        )
-
-        # Create a rounded mask
-        mask = QBitmap(scaled_pixmap.size())
-        mask.fill(Qt.GlobalColor.color0)
-        painter = QPainter(mask)
-        painter.setBrush(Qt.GlobalColor.color1)
-        painter.setPen(Qt.PenStyle.NoPen)
-        painter.drawRoundedRect(mask.rect(), 20, 20)
-        painter.end()
-
-        # Apply the mask to the pixmap
-        rounded_pixmap = scaled_pixmap.copy()
-        rounded_pixmap.setMask(mask)
-
-        self.image_label.setPixmap(rounded_pixmap)
+        self.image_label.setPixmap(QPixmap.fromImage(thumbnail))
 
         # Clear previous image if any
         for i in reversed(range(self.ui_manager.image_layout.count())):
@@ -443,4 +620,9 @@ class LlamaAssistant(QMainWindow):
     def closeEvent(self, event):
         if self.wake_word_detector is not None:
             self.wake_word_detector.stop()
+        if self.download_thread is not None:
+            self.download_thread.stop()
+        self.processing_thread.stop()
+        if self.conversation_store is not None:
+            self.conversation_store.close()
         super().closeEvent(event)
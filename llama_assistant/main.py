@@ -1,11 +1,31 @@
+import importlib
 import sys
 import multiprocessing
-from PyQt5.QtWidgets import QApplication
-from PyQt5.QtCore import Qt
-from llama_assistant.llama_assistant_app import LlamaAssistant
+
+# Headless commands, imported lazily so that they do not need PyQt5
+COMMANDS = {
+    "bench": "llama_assistant.bench",
+    "autotune": "llama_assistant.autotune",
+    "daemon": "llama_assistant.daemon",
+    "ask": "llama_assistant.ask",
+    "serve": "llama_assistant.server",
+    "search": "llama_assistant.conversation_store",
+    "batch-images": "llama_assistant.batch_images",
+    "download": "llama_assistant.download_manager",
+}
 
 
 def main():
+    # The inference worker is started as a new process, also from frozen builds
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        command = importlib.import_module(COMMANDS[sys.argv[1]])
+        sys.exit(command.main(sys.argv[2:]))
+
+    from PyQt5.QtWidgets import QApplication
+    from PyQt5.QtCore import Qt
+    from llama_assistant.llama_assistant_app import LlamaAssistant
+
     # Enable high DPI scaling
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
     QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True)
@@ -17,5 +37,4 @@ def main():
 
 
 if __name__ == "__main__":
-    multiprocessing.freeze_support()
     main()
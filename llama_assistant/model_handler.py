@@ -1,6 +1,11 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from collections import OrderedDict
+import gc
+import hashlib
+import json
+import os
 import time
-from threading import Timer
+from threading import Event, RLock, Thread
 from llama_cpp import Llama
 from llama_cpp.llama_chat_format import (
     MoondreamChatHandler,
@@ -9,139 +14,340 @@ from llama_cpp.llama_chat_format import (
     Llava16ChatHandler,
 )
 
-from llama_assistant import config
+from llama_assistant import autotune, config, hardware
+from llama_assistant.batching import BATCHING_PARAMS, BatchingEngine
+from llama_assistant.chat_session import ChatSession
+from llama_assistant.download_manager import DownloadManager
+from llama_assistant.gguf_metadata import read_gguf_metadata
+from llama_assistant.image_embedding_cache import ImageEmbeddingCache
+from llama_assistant.model_registry import Model, ModelChange, registry
+from llama_assistant.prefix_cache import PrefixCache, capture_state, restore_state
+from llama_assistant.response_cache import ResponseCache, file_fingerprint
+from llama_assistant.semantic_cache import SemanticCache
 
 
-class Model:
-    def __init__(
-        self,
-        model_type: str,
-        model_id: str,
-        model_name: str,
-        model_path: Optional[str] = None,
-        repo_id: Optional[str] = None,
-        filename: Optional[str] = None,
-    ):
-        self.model_type = model_type
-        self.model_id = model_id
-        self.model_name = model_name
-        self.model_path = model_path
-        self.repo_id = repo_id
-        self.filename = filename
+# Chat handlers of the image models, matched against the model ID in this order
+VISION_CHAT_HANDLERS = [
+    ("moondream2", MoondreamChatHandler),
+    ("MiniCPM", MiniCPMv26ChatHandler),
+    ("llava-v1.5", Llava15ChatHandler),
+    ("llava-v1.6", Llava16ChatHandler),
+]
+
+# GGML tensor types accepted for the K and V caches
+KV_CACHE_TYPES = {
+    "f32": 0,
+    "f16": 1,
+    "q4_0": 2,
+    "q4_1": 3,
+    "q5_0": 6,
+    "q5_1": 7,
+    "q8_0": 8,
+}
+
+RUNTIME_PROFILE_KEYS = {
+    "n_ctx",
+    "n_threads",
+    "n_threads_batch",
+    "n_batch",
+    "use_mmap",
+    "use_mlock",
+    "type_k",
+    "type_v",
+    "flash_attn",
+    "embedding",
+}
+
+
+# Bytes per element of the GGML types accepted for the K and V caches, by type number
+KV_CACHE_TYPE_SIZES = {0: 4.0, 1: 2.0, 2: 18 / 32, 3: 20 / 32, 6: 22 / 32, 7: 24 / 32, 8: 34 / 32}
+
+
+def estimate_kv_cache_size(metadata: Dict, type_k: int = 1, type_v: int = 1) -> float:
+    """Bytes of K and V cache per context position, for every layer"""
+    arch = metadata.get("general.architecture", "llama")
+    n_layer = int(metadata.get(f"{arch}.block_count", 32))
+    n_embd = int(metadata.get(f"{arch}.embedding_length", 4096))
+    n_head = max(int(metadata.get(f"{arch}.attention.head_count", 1)), 1)
+    n_head_kv = int(metadata.get(f"{arch}.attention.head_count_kv", n_head))
+    key_length = int(metadata.get(f"{arch}.attention.key_length", n_embd // n_head))
+    value_length = int(metadata.get(f"{arch}.attention.value_length", n_embd // n_head))
+    return (
+        n_layer
+        * n_head_kv
+        * (
+            key_length * KV_CACHE_TYPE_SIZES.get(type_k, 2.0)
+            + value_length * KV_CACHE_TYPE_SIZES.get(type_v, 2.0)
+        )
+    )
+
 
-    def is_online(self) -> bool:
-        return self.repo_id is not None and self.filename is not None
+def estimate_model_memory(
+    model_path: str, clip_model_path: Optional[str], metadata: Dict, runtime: Dict, n_ctx: int
+) -> int:
+    """Estimate the resident size of a model: GGUF weights, the mmproj file and the KV cache
+    of n_ctx positions in the cache types of the runtime profile"""
+    size = 0
+    for path in (model_path, clip_model_path):
+        if path and os.path.exists(path):
+            size += os.path.getsize(path)
+    kv_size = estimate_kv_cache_size(metadata, runtime.get("type_k", 1), runtime.get("type_v", 1))
+    return size + int(kv_size * n_ctx)
 
 
 class ModelHandler:
     def __init__(self):
-        self.supported_models: List[Model] = []
-        self.loaded_model: Optional[Dict] = None
-        self.current_model_id: Optional[str] = None
-        self.unload_timer: Optional[Timer] = None
+        self.registry = registry
+        self.loaded_models: "OrderedDict[str, Dict]" = OrderedDict()
+        self.memory_budget = int(config.DEFAULT_SETTINGS["model_memory_budget_gb"] * 1024**3)
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "idle_unloads": 0,
+            "pressure_unloads": 0,
+        }
+        self.idle_ttl = config.DEFAULT_SETTINGS["model_idle_ttl"]
+        self.memory_pressure_percent = config.DEFAULT_SETTINGS["memory_pressure_percent"]
+        self.batching_slots = config.DEFAULT_SETTINGS["batching_slots"]
+        self.lock = RLock()
+        self.prefix_cache = PrefixCache()
+        self.response_cache = ResponseCache()
+        self.download_manager = DownloadManager()
+        self.response_cache_enabled = config.DEFAULT_SETTINGS["response_cache"]
+        self.semantic_cache = SemanticCache(
+            threshold=config.DEFAULT_SETTINGS["semantic_cache_threshold"]
+        )
+        self.semantic_cache_enabled = config.DEFAULT_SETTINGS["semantic_cache"]
+        self.embedding_model_id = config.DEFAULT_SETTINGS["embedding_model"]
+        self.image_embedding_cache = ImageEmbeddingCache(
+            memory_capacity=config.DEFAULT_SETTINGS["image_embedding_cache_mb"] * 1024**2,
+            disk_enabled=config.DEFAULT_SETTINGS["image_embedding_disk_cache"],
+        )
 
-    def refresh_supported_models(self):
-        self.supported_models = [Model(**model_data) for model_data in config.models]
+        # One reaper thread for the whole pool instead of a timer per request
+        self.reaper_interval = 30
+        self.reported_lookups = 0
+        self.reaper_stop = Event()
+        self.reaper = Thread(target=self._reap_loop, name="model-reaper", daemon=True)
+        self.reaper.start()
+        self.registry.add_listener(self.on_models_changed)
 
     def list_supported_models(self) -> List[Model]:
-        return self.supported_models
+        return self.registry.list()
 
     def add_supported_model(self, model: Model):
-        self.supported_models.append(model)
+        self.registry.add(model)
 
     def remove_supported_model(self, model_id: str):
-        self.supported_models = [m for m in self.supported_models if m.model_id != model_id]
-        if self.current_model_id == model_id:
-            self.unload_model()
+        self.registry.remove(model_id)
+
+    def on_models_changed(self, changes: List[ModelChange]):
+        with self.lock:
+            for _, model_id in changes:
+                model_data = self.loaded_models.get(model_id)
+                if model_data is None:
+                    continue
+                model = self.registry.models.get(model_id)
+                loaded = model_data["entry"]
+                if model is not None and (
+                    model.model_type,
+                    model.get_file_key(),
+                    model.runtime,
+                ) == (loaded.model_type, loaded.get_file_key(), loaded.runtime):
+                    # Renamed or a new idle TTL, the loaded model can stay
+                    model_data["entry"] = model
+                    model_data["idle_ttl"] = model.idle_ttl
+                else:
+                    # Loaded again from the new entry on next use
+                    self.unload_model(model_id)
+
+    def apply_settings(self, settings: Dict):
+        settings = {**config.DEFAULT_SETTINGS, **settings}
+        self.set_memory_budget(settings["model_memory_budget_gb"])
+        self.response_cache_enabled = settings["response_cache"]
+        self.semantic_cache_enabled = settings["semantic_cache"]
+        self.semantic_cache.threshold = settings["semantic_cache_threshold"]
+        self.embedding_model_id = settings["embedding_model"]
+        self.idle_ttl = settings["model_idle_ttl"]
+        self.memory_pressure_percent = settings["memory_pressure_percent"]
+        self.batching_slots = settings["batching_slots"]
+        self.image_embedding_cache.memory_capacity = (
+            settings["image_embedding_cache_mb"] * 1024**2
+        )
+        self.image_embedding_cache.disk_enabled = settings["image_embedding_disk_cache"]
+
+    def set_memory_budget(self, budget_gb: float):
+        self.memory_budget = int(budget_gb * 1024**3)
+        self._enforce_memory_budget(keep=tuple(self.loaded_models)[-1:])
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "loaded_models": list(self.loaded_models.keys()),
+            "memory_used": sum(m["memory"] for m in self.loaded_models.values()),
+            "memory_budget": self.memory_budget,
+            "batching": {
+                model_id: model_data["engine"].get_stats()
+                for model_id, model_data in self.loaded_models.items()
+                if "engine" in model_data
+            },
+            "semantic_cache": self.semantic_cache.get_stats(),
+            "image_embedding_cache": self.image_embedding_cache.get_stats(),
+        }
+
+    def get_runtime_kwargs(self, model: Model, overrides: Optional[Dict] = None) -> Dict:
+        """Llama keyword arguments from the hardware defaults, the autotuned settings of
+        this host and the model's runtime profile, in increasing priority"""
+        profile = hardware.default_runtime_profile()
+        profile.update(autotune.get_tuned_profile(model.get_file_key()))
+        profile.update(model.runtime)
+        profile.update(overrides or {})
+
+        runtime = {}
+        for key, value in profile.items():
+            if key not in RUNTIME_PROFILE_KEYS:
+                print(f"Ignoring unknown runtime option for {model.model_id}: {key}")
+            elif key in ("type_k", "type_v"):
+                if value not in KV_CACHE_TYPES:
+                    print(f"Ignoring unsupported KV cache type for {model.model_id}: {value}")
+                    continue
+                runtime[key] = KV_CACHE_TYPES[value]
+            else:
+                runtime[key] = value
+        return runtime
+
+    def is_model_loaded(self, model_id: str) -> bool:
+        return model_id in self.loaded_models
 
-    def load_model(self, model_id: str) -> Optional[Dict]:
-        self.refresh_supported_models()
-        if self.current_model_id == model_id and self.loaded_model:
-            return self.loaded_model
+    def get_model(self, model_id: str) -> Optional[Model]:
+        return self.registry.get(model_id)
 
-        self.unload_model()  # Unload the current model if any
+    def load_model(
+        self, model_id: str, runtime: Optional[Dict] = None, keep: Tuple[str, ...] = ()
+    ) -> Optional[Dict]:
+        """Load a model, or reload it with the given runtime options overriding its profile.
+        The models in keep are in use and not evicted to make room for it."""
+        # Loads may come from the preload thread and a processing thread at the same time
+        with self.lock:
+            if runtime is not None:
+                self.unload_model(model_id)
+            return self._load_model(model_id, runtime, keep)
 
-        model = next((m for m in self.supported_models if m.model_id == model_id), None)
+    def warm_up(self, model_id: str) -> bool:
+        """Load a model and run a tiny completion so the first real request is fast"""
+        with self.lock:
+            if self.is_model_loaded(model_id):
+                return True
+            model_data = self._load_model(model_id)
+            if not model_data:
+                return False
+            model_data["model"].create_chat_completion(
+                messages=[{"role": "user", "content": "Hi"}], max_tokens=1
+            )
+            return True
+
+    def _load_model(
+        self, model_id: str, overrides: Optional[Dict] = None, keep: Tuple[str, ...] = ()
+    ) -> Optional[Dict]:
+        if model_id in self.loaded_models:
+            self.stats["hits"] += 1
+            self.loaded_models.move_to_end(model_id)
+            self.loaded_models[model_id]["last_used"] = time.time()
+            return self.loaded_models[model_id]
+
+        self.stats["misses"] += 1
+
+        model = self.get_model(model_id)
         if not model:
             print(f"Model with ID {model_id} not found.")
             return None
 
+        runtime = self.get_runtime_kwargs(model, overrides)
+        print(f"Loading model {model_id} with runtime profile: {runtime}")
+        chat_handler = None
         if model.is_online():
-            if model.model_type == "text":
-                loaded_model = Llama.from_pretrained(
-                    repo_id=model.repo_id,
-                    filename=model.filename,
-                    n_ctx=2048,
-                )
-            elif model.model_type == "image":
-                if "moondream2" in model.model_id:
-                    chat_handler = MoondreamChatHandler.from_pretrained(
-                        repo_id="vikhyatk/moondream2",
-                        filename="*mmproj*",
-                    )
-                    loaded_model = Llama.from_pretrained(
-                        repo_id=model.repo_id,
-                        filename=model.filename,
-                        chat_handler=chat_handler,
-                        n_ctx=2048,
-                    )
-                elif "MiniCPM" in model.model_id:
-                    chat_handler = MiniCPMv26ChatHandler.from_pretrained(
-                        repo_id=model.repo_id,
-                        filename="*mmproj*",
-                    )
-                    loaded_model = Llama.from_pretrained(
-                        repo_id=model.repo_id,
-                        filename=model.filename,
-                        chat_handler=chat_handler,
-                        n_ctx=2048,
-                    )
-                elif "llava-v1.5" in model.model_id:
-                    chat_handler = Llava15ChatHandler.from_pretrained(
-                        repo_id=model.repo_id,
-                        filename="*mmproj*",
-                    )
-                    loaded_model = Llama.from_pretrained(
-                        repo_id=model.repo_id,
-                        filename=model.filename,
-                        chat_handler=chat_handler,
-                        n_ctx=2048,
-                    )
-                elif "llava-v1.6" in model.model_id:
-                    chat_handler = Llava16ChatHandler.from_pretrained(
-                        repo_id=model.repo_id,
-                        filename="*mmproj*",
-                    )
-                    loaded_model = Llama.from_pretrained(
-                        repo_id=model.repo_id,
-                        filename=model.filename,
-                        chat_handler=chat_handler,
-                        n_ctx=2048,
-                    )
-            else:
+            if model.model_type not in ("text", "embedding", "image"):
                 print(f"Unsupported model type: {model.model_type}")
                 return None
+            # Downloaded once with resume and checksums, later loads only open local files
+            files = self.download_manager.ensure(
+                model.model_id, model.repo_id, model.filename, model.model_type
+            )
+            model_path = files["model_path"]
+            if model.model_type == "image":
+                chat_handler_class = next(
+                    (c for pattern, c in VISION_CHAT_HANDLERS if pattern in model.model_id), None
+                )
+                if chat_handler_class is None:
+                    print(f"Unsupported image model: {model.model_id}")
+                    return None
+                chat_handler = chat_handler_class(clip_model_path=files["clip_model_path"])
         else:
             # Load model from local path
-            loaded_model = Llama(model_path=model.model_path)
+            model_path = model.model_path
+        clip_model_path = getattr(chat_handler, "clip_model_path", None)
+
+        # Make room before loading, so the pool never holds more than the budget
+        metadata = read_gguf_metadata(model_path)
+        n_ctx = runtime.get("n_ctx", 512) or metadata.get(
+            f"{metadata.get('general.architecture', 'llama')}.context_length", 0
+        )
+        self._enforce_memory_budget(
+            reserve=estimate_model_memory(model_path, clip_model_path, metadata, runtime, n_ctx),
+            keep=keep,
+        )
+
+        loaded_model = Llama(model_path=model_path, chat_handler=chat_handler, **runtime)
+        if chat_handler is not None:
+            self.image_embedding_cache.install(chat_handler, loaded_model.n_embd())
 
-        self.loaded_model = {
+        metadata = loaded_model.metadata or metadata
+        model_data = {
             "model": loaded_model,
             "last_used": time.time(),
+            "memory": estimate_model_memory(
+                model_path, clip_model_path, metadata, runtime, loaded_model.n_ctx()
+            ),
+            "kv_cache_size": estimate_kv_cache_size(
+                metadata, runtime.get("type_k", 1), runtime.get("type_v", 1)
+            ),
+            "idle_ttl": model.idle_ttl,
+            "entry": model,
         }
-        self.current_model_id = model_id
-        self._schedule_unload()
+        self.loaded_models[model_id] = model_data
+        self._enforce_memory_budget(keep=keep + (model_id,))
+        print(f"Loaded model: {model_id}, pool stats: {self.stats}")
 
-        return self.loaded_model
+        return model_data
 
-    def unload_model(self):
-        if self.loaded_model:
-            print(f"Unloading model: {self.current_model_id}")
-            self.loaded_model = None
-            self.current_model_id = None
-        if self.unload_timer:
-            self.unload_timer.cancel()
-            self.unload_timer = None
+    def unload_model(self, model_id: Optional[str] = None):
+        """Unload one model, or every loaded model if no ID is given"""
+        model_ids = [model_id] if model_id else list(self.loaded_models.keys())
+        for unload_id in model_ids:
+            model_data = self.loaded_models.pop(unload_id, None)
+            if model_data is not None:
+                print(f"Unloading model: {unload_id}")
+                if "engine" in model_data:
+                    model_data["engine"].close()
+
+    def _enforce_memory_budget(self, reserve: int = 0, keep: Tuple[str, ...] = ()):
+        """Evict least recently used models until the pool and reserve more bytes fit in the
+        budget. The models in keep are never evicted, so a model larger than the budget still
+        runs."""
+        while True:
+            memory_used = sum(m["memory"] for m in self.loaded_models.values())
+            if memory_used + reserve <= self.memory_budget:
+                break
+            evicted_id = next((m for m in self.loaded_models if m not in keep), None)
+            if evicted_id is None:
+                break
+            print(
+                f"Model pool over budget ({(memory_used + reserve) / 1024**3:.1f} GB > "
+                f"{self.memory_budget / 1024**3:.1f} GB), evicting {evicted_id}"
+            )
+            self.unload_model(evicted_id)
+            self.stats["evictions"] += 1
 
     def chat_completion(
         self,
@@ -149,41 +355,306 @@ class ModelHandler:
         message: str,
         image: Optional[str] = None,
         stream: bool = False,
+        prefix: Optional[str] = None,
+        session: Optional[ChatSession] = None,
+        task: Optional[str] = None,
+        sampling_params: Optional[Dict] = None,
     ) -> str:
+        sampling_params = sampling_params or {}
         model_data = self.load_model(model_id)
         if not model_data:
             return "Failed to load model"
 
         model = model_data["model"]
         model_data["last_used"] = time.time()
-        self._schedule_unload()
 
-        if image:
-            response = model.create_chat_completion(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": message},
-                            {"type": "image_url", "image_url": {"url": image}},
-                        ],
-                    }
-                ],
-                stream=stream,
+        # Responses that depend on earlier turns of a conversation are not cached
+        cache_key = None
+        if self.response_cache_enabled and not (session is not None and session.messages):
+            cache_key = ResponseCache.make_key(
+                file_fingerprint(model.model_path),
+                task,
+                message,
+                hashlib.sha256(image.encode("utf-8")).hexdigest() if image else None,
+                sampling_params,
             )
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                if session is not None:
+                    session.add_turn(message, cached_response)
+                return self._replay_response(cached_response, stream)
+
+        # Near-duplicate chat prompts can share an answer, task prompts can not: two texts
+        # to summarize or fix can be similar and still need different answers
+        embedding = None
+        if (
+            self.semantic_cache_enabled
+            and task == "chat"
+            and not image
+            and not (session is not None and session.messages)
+        ):
+            # The chat model answers this request, loading the embedding model must not
+            # evict it
+            embedding = self.embed(message, keep=(model_id,))
+            match = self.semantic_cache.lookup(embedding, model.model_path)
+            if match is not None:
+                cached_response, similarity = match
+                print(f"Semantic cache hit with similarity {similarity:.3f}")
+                if session is not None:
+                    session.add_turn(message, cached_response)
+                return self._replay_response(cached_response, stream)
+
+        if session is not None and session.messages:
+            session.trim(model, message)
+        if session is not None and session.state is not None:
+            if not restore_state(model, session.state):
+                # The transcript in the messages is evaluated again instead
+                session.state = None
+        elif prefix is not None and not image:
+            self._restore_prefix(model, prefix)
+
+        if image:
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": message},
+                        {"type": "image_url", "image_url": {"url": image}},
+                    ],
+                }
+            ]
+        elif session is not None:
+            messages = session.build_messages(message)
         else:
-            response = model.create_chat_completion(
-                messages=[{"role": "user", "content": message}], stream=stream
+            messages = [{"role": "user", "content": message}]
+        response = model.create_chat_completion(messages=messages, stream=stream, **sampling_params)
+
+        def on_complete(content: str):
+            if session is not None:
+                session.add_turn(message, content)
+                session.state = capture_state(model)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, content)
+            if embedding is not None:
+                self.semantic_cache.add(embedding, model.model_path, message, content)
+
+        if stream:
+            return self._stream_response(response, on_complete)
+        on_complete(response["choices"][0]["message"]["content"])
+        return response
+
+    def create_chat_completion(
+        self, model_id: str, messages: List[Dict], stream: bool = False, **params
+    ):
+        """Chat completion over a whole OpenAI-style message list, for the API server"""
+        model_data = self.load_model(model_id)
+        if not model_data:
+            raise RuntimeError(f"Failed to load model: {model_id}")
+        model = model_data["model"]
+        model_data["last_used"] = time.time()
+
+        # Tool calls can not be replayed from a cached text
+        cache_key = None
+        if self.response_cache_enabled and "tools" not in params:
+            cache_key = ResponseCache.make_key(
+                file_fingerprint(model.model_path),
+                "api",
+                json.dumps(messages, sort_keys=True),
+                None,
+                params,
             )
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                return self._replay_response(cached_response, stream)
 
+        if self.can_batch(model_id, messages, params):
+            response = self._get_batching_engine(model_data).create_chat_completion(
+                messages, **params
+            )
+            if not stream:
+                response = self._collect_stream(response)
+        else:
+            response = model.create_chat_completion(messages=messages, stream=stream, **params)
+
+        def on_complete(content: str):
+            if cache_key is not None and content:
+                self.response_cache.put(cache_key, content)
+
+        if stream:
+            return self._stream_response(response, on_complete)
+        on_complete(response["choices"][0]["message"]["content"])
         return response
 
-    def _schedule_unload(self):
-        if self.unload_timer:
-            self.unload_timer.cancel()
+    def can_batch(self, model_id: str, messages: List[Dict], params: Dict) -> bool:
+        """Whether a request can run in the model's batching engine alongside others"""
+        if self.batching_slots <= 1 or not set(params) <= BATCHING_PARAMS:
+            return False
+        model = self.get_model(model_id)
+        # Images need the chat handler of the model
+        return (
+            model is not None
+            and model.model_type == "text"
+            and all(isinstance(m.get("content"), str) for m in messages)
+        )
+
+    def _get_batching_engine(self, model_data: Dict) -> BatchingEngine:
+        with self.lock:
+            if "engine" not in model_data:
+                model = model_data["model"]
+                # The engine has its own context with a slot of n_ctx positions per sequence
+                engine_memory = int(
+                    model_data["kv_cache_size"] * model.n_ctx() * self.batching_slots
+                )
+                self._enforce_memory_budget(
+                    reserve=engine_memory, keep=(model_data["entry"].model_id,)
+                )
+                model_data["engine"] = BatchingEngine(
+                    model, n_slots=self.batching_slots, n_batch=model.n_batch
+                )
+                model_data["memory"] += engine_memory
+            return model_data["engine"]
+
+    def _collect_stream(self, stream) -> Dict:
+        content = ""
+        finish_reason = None
+        for chunk in stream:
+            choice = chunk["choices"][0]
+            content += choice["delta"].get("content") or ""
+            finish_reason = choice["finish_reason"] or finish_reason
+        return {
+            "id": chunk["id"],
+            "object": "chat.completion",
+            "created": chunk["created"],
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": finish_reason,
+                }
+            ],
+        }
+
+    def create_embedding(self, text, model_id: Optional[str] = None) -> Dict:
+        """OpenAI-style embeddings of a text or a list of texts"""
+        model_id = model_id or self.embedding_model_id
+        model_data = self.load_model(model_id)
+        if not model_data:
+            raise RuntimeError(f"Failed to load embedding model: {model_id}")
+        model_data["last_used"] = time.time()
+        return model_data["model"].create_embedding(text, model=model_id)
+
+    def embed(self, text: str, keep: Tuple[str, ...] = ()) -> List[float]:
+        model_data = self.load_model(self.embedding_model_id, keep=keep)
+        if not model_data:
+            raise RuntimeError(f"Failed to load embedding model: {self.embedding_model_id}")
+        return model_data["model"].embed(text)
+
+    def _stream_response(self, stream, on_complete):
+        content = ""
+        try:
+            for chunk in stream:
+                content += chunk["choices"][0]["delta"].get("content") or ""
+                yield chunk
+        finally:
+            # Closing this generator, e.g. when a client disconnects, also stops the
+            # generation behind it
+            if hasattr(stream, "close"):
+                stream.close()
+        # Only complete responses are added to the history and the cache, a closed
+        # stream never gets here
+        on_complete(content)
+
+    def _replay_response(self, content: str, stream: bool):
+        if stream:
+            return self._replay_stream(content)
+        return {
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ]
+        }
+
+    def _replay_stream(self, content: str):
+        yield {"choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]}
+        yield {"choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]}
+        yield {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+
+    def _restore_prefix(self, model: Llama, prefix: str):
+        # Put the KV state of the chat header and the task instruction in place, so that
+        # llama.cpp only has to evaluate the tokens of the user's text
+        entry = self.prefix_cache.get(model, prefix)
+        if entry is not None:
+            if restore_state(model, entry):
+                return
+            self.prefix_cache.discard(model, prefix)
 
-        self.unload_timer = Timer(3600, self.unload_model)
-        self.unload_timer.start()
+        model.create_chat_completion(messages=[{"role": "user", "content": prefix}], max_tokens=1)
+        self.prefix_cache.put(model, prefix, capture_state(model))
+
+    def stop_reaper(self):
+        self.reaper_stop.set()
+        self.reaper.join()
+
+    def _reap_loop(self):
+        while not self.reaper_stop.wait(self.reaper_interval):
+            try:
+                with self.lock:
+                    self._unload_idle_models()
+                    self._relieve_memory_pressure()
+                self._report_cache_stats()
+            except Exception as e:
+                print(f"Model reaper failed: {e}")
+
+    def _report_cache_stats(self):
+        # Printed from the reaper instead of per request, and only after new lookups
+        lookups = self.semantic_cache.stats["lookups"]
+        if lookups != self.reported_lookups:
+            self.reported_lookups = lookups
+            print(f"Semantic cache stats: {self.semantic_cache.get_stats()}")
+
+    def _unload_idle_models(self):
+        now = time.time()
+        for model_id, model_data in list(self.loaded_models.items()):
+            idle_ttl = model_data["idle_ttl"]
+            if idle_ttl is None:
+                idle_ttl = self.idle_ttl
+            idle_time = now - model_data["last_used"]
+            if idle_ttl and idle_time > idle_ttl:
+                print(f"Model {model_id} idle for {idle_time:.0f}s (TTL {idle_ttl:.0f}s)")
+                self.unload_model(model_id)
+                self.stats["idle_unloads"] += 1
+
+    def _is_under_memory_pressure(self) -> bool:
+        memory = hardware.memory_info()
+        if not memory["total"]:
+            return False
+        return memory["available"] * 100 < memory["total"] * self.memory_pressure_percent
+
+    def _relieve_memory_pressure(self):
+        if not self._is_under_memory_pressure():
+            return
+
+        # The in-memory cache tiers are cheap to rebuild, models are not
+        print("Memory pressure, clearing the in-memory prefix, response and image caches")
+        self.prefix_cache.clear_memory()
+        self.response_cache.clear_memory()
+        self.image_embedding_cache.clear_memory()
+        gc.collect()
+
+        # Evict least recently used models, but always keep the most recent one
+        while len(self.loaded_models) > 1 and self._is_under_memory_pressure():
+            evicted_id = next(iter(self.loaded_models))
+            memory = hardware.memory_info()
+            print(
+                f"Memory pressure ({memory['available'] / 1024**3:.1f} GB of "
+                f"{memory['total'] / 1024**3:.1f} GB available), unloading {evicted_id}"
+            )
+            self.unload_model(evicted_id)
+            self.stats["pressure_unloads"] += 1
+            gc.collect()
 
 
 # Example usage
@@ -0,0 +1,198 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llama_assistant import config
+
+# Changes passed to the listeners, e.g. ("changed", "my-org/my-model")
+ModelChange = Tuple[str, str]
+
+
+class Model:
+    def __init__(
+        self,
+        model_type: str,
+        model_id: str,
+        model_name: str,
+        model_path: Optional[str] = None,
+        repo_id: Optional[str] = None,
+        filename: Optional[str] = None,
+        runtime: Optional[Dict] = None,
+        idle_ttl: Optional[float] = None,
+    ):
+        self.model_type = model_type
+        self.model_id = model_id
+        self.model_name = model_name
+        self.model_path = model_path
+        self.repo_id = repo_id
+        self.filename = filename
+        self.runtime = runtime or {}
+        self.idle_ttl = idle_ttl
+
+    def is_online(self) -> bool:
+        return self.repo_id is not None and self.filename is not None
+
+    def get_file_key(self) -> str:
+        """Identify the model file, also before an online model has been downloaded"""
+        if self.is_online():
+            return f"{self.repo_id}/{self.filename}"
+        return str(self.model_path)
+
+
+class ModelRegistry:
+    """The built-in and custom models indexed by model ID.
+
+    The index is built once and updated when custom_models.json changes: only the entries
+    that were added, changed or removed are rebuilt, and the listeners get the list of
+    changes. The GUI reloads on file system notifications, every other process notices
+    changes by checking the modification time of the file at most every poll_interval
+    seconds on lookup.
+    """
+
+    def __init__(
+        self,
+        custom_models_file: Path = config.custom_models_file,
+        default_models: Optional[List[Dict]] = None,
+        poll_interval: float = 2.0,
+    ):
+        self.custom_models_file = Path(custom_models_file)
+        self.poll_interval = poll_interval
+        self.default_models = {
+            data["model_id"]: Model(**data)
+            for data in (config.DEFAULT_MODELS if default_models is None else default_models)
+        }
+        self.custom_data: Dict[str, Dict] = {}
+        self.custom_models: Dict[str, Model] = {}
+        self.extra_models: Dict[str, Model] = {}
+        self.models: Dict[str, Model] = dict(self.default_models)
+        self.listeners: List[Callable[[List[ModelChange]], None]] = []
+        self.lock = threading.RLock()
+        self.file_stamp = None
+        self.last_check = 0.0
+        self.reload()
+
+    def get(self, model_id: str) -> Optional[Model]:
+        self.check()
+        return self.models.get(model_id)
+
+    def list(self, model_type: Optional[str] = None) -> List[Model]:
+        self.check()
+        return [m for m in self.models.values() if model_type in (None, m.model_type)]
+
+    def add_listener(self, listener: Callable[[List[ModelChange]], None]):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[List[ModelChange]], None]):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def add(self, model: Model):
+        """Register a model for this process only, it is not saved to custom_models.json"""
+        with self.lock:
+            change = "changed" if model.model_id in self.models else "added"
+            self.extra_models[model.model_id] = model
+            self._rebuild_index()
+        self._notify([(change, model.model_id)])
+
+    def remove(self, model_id: str):
+        with self.lock:
+            if self.extra_models.pop(model_id, None) is None:
+                return
+            self._rebuild_index()
+        change = "changed" if model_id in self.models else "removed"
+        self._notify([(change, model_id)])
+
+    def save_custom_models(self, custom_models: List[Dict]):
+        """Write the custom models to custom_models.json and apply them right away"""
+        config.custom_models[:] = custom_models
+        config.save_custom_models()
+        self.reload()
+
+    def check(self):
+        """Reload if custom_models.json changed, at most once every poll_interval seconds"""
+        now = time.monotonic()
+        if now - self.last_check < self.poll_interval:
+            return
+        self.last_check = now
+        if self._stat() != self.file_stamp:
+            self.reload()
+
+    def reload(self) -> List[ModelChange]:
+        with self.lock:
+            stamp = self._stat()
+            try:
+                with open(self.custom_models_file, "r") as f:
+                    entries = json.load(f).get("custom_models", [])
+            except FileNotFoundError:
+                entries = []
+            except (OSError, ValueError, AttributeError) as e:
+                # Most likely an editor is halfway through saving, the next change retries
+                print(f"Failed to read {self.custom_models_file}: {e}")
+                return []
+            self.file_stamp = stamp
+
+            custom_data = {}
+            custom_models = {}
+            changes = []
+            for data in entries:
+                model_id = data.get("model_id") if isinstance(data, dict) else None
+                if model_id is None:
+                    print(f"Ignoring custom model without a model_id: {data}")
+                    continue
+                if model_id in self.default_models or model_id in custom_data:
+                    print(f"Ignoring custom model with a duplicate model_id: {model_id}")
+                    continue
+                if self.custom_data.get(model_id) == data:
+                    # Unchanged entries keep their Model object
+                    custom_models[model_id] = self.custom_models[model_id]
+                else:
+                    try:
+                        custom_models[model_id] = Model(**data)
+                    except TypeError as e:
+                        print(f"Ignoring invalid custom model {model_id}: {e}")
+                        continue
+                    changes.append(
+                        ("changed" if model_id in self.custom_data else "added", model_id)
+                    )
+                custom_data[model_id] = data
+            changes.extend(("removed", m) for m in self.custom_data if m not in custom_data)
+            # The custom models dialog edits config.custom_models by position in the file
+            config.custom_models[:] = [data for data in entries if isinstance(data, dict)]
+            config.models = config.DEFAULT_MODELS + config.custom_models
+            if not changes and list(custom_data) == list(self.custom_data):
+                return []
+
+            self.custom_data = custom_data
+            self.custom_models = custom_models
+            self._rebuild_index()
+        if changes:
+            self._notify(changes)
+        return changes
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.custom_models_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _rebuild_index(self):
+        models = dict(self.default_models)
+        for model_id, model in self.custom_models.items():
+            models.setdefault(model_id, model)
+        models.update(self.extra_models)
+        # Swapped in one assignment so lookups from other threads never see a partial index
+        self.models = models
+
+    def _notify(self, changes: List[ModelChange]):
+        for listener in list(self.listeners):
+            try:
+                listener(changes)
+            except Exception as e:
+                print(f"Model registry listener failed: {e}")
+
+
+registry = ModelRegistry()
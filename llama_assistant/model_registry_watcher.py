@@ -0,0 +1,48 @@
+from typing import List
+
+from PyQt5.QtCore import QFileSystemWatcher, QObject, QTimer, pyqtSignal
+
+from llama_assistant.model_registry import ModelChange, ModelRegistry
+
+
+class ModelRegistryWatcher(QObject):
+    """Reloads the model registry when custom_models.json changes on disk.
+
+    models_changed is emitted in the GUI thread with the list of (change, model ID)
+    pairs, also for changes saved from this process.
+    """
+
+    models_changed = pyqtSignal(list)
+    RELOAD_DELAY = 200  # Milliseconds, editors can save a file in several writes
+
+    def __init__(self, registry: ModelRegistry, parent=None):
+        super().__init__(parent)
+        self.registry = registry
+        self.path = str(registry.custom_models_file)
+        self.watcher = QFileSystemWatcher(self)
+        # The directory is watched too, editors that save by renaming replace the file
+        self.watcher.addPath(str(registry.custom_models_file.parent))
+        if registry.custom_models_file.exists():
+            self.watcher.addPath(self.path)
+        self.watcher.fileChanged.connect(self.schedule_reload)
+        self.watcher.directoryChanged.connect(self.schedule_reload)
+        self.reload_timer = QTimer(self)
+        self.reload_timer.setSingleShot(True)
+        self.reload_timer.setInterval(self.RELOAD_DELAY)
+        self.reload_timer.timeout.connect(self.reload)
+        # Listeners can be called from other threads, the signal is queued to this one
+        registry.add_listener(self.on_registry_changed)
+
+    def schedule_reload(self, _path: str):
+        self.reload_timer.start()
+
+    def reload(self):
+        if self.path not in self.watcher.files() and self.registry.custom_models_file.exists():
+            self.watcher.addPath(self.path)
+        self.registry.reload()
+
+    def on_registry_changed(self, changes: List[ModelChange]):
+        self.models_changed.emit(changes)
+
+    def close(self):
+        self.registry.remove_listener(self.on_registry_changed)
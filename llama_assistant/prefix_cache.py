@@ -0,0 +1,154 @@
+import ctypes
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+import llama_cpp
+import numpy as np
+from llama_cpp import Llama, LlamaState
+
+from llama_assistant import config
+
+
+def capture_state(model: Llama) -> Dict:
+    """Copy the evaluated tokens and the llama.cpp context state of a model.
+
+    Unlike Llama.save_state this skips the logits buffer, which can be hundreds of MB
+    for large vocabularies. llama.cpp always re-evaluates at least the last prompt
+    token, so the logits are never read after a state is restored.
+    """
+    state_size = llama_cpp.llama_get_state_size(model.ctx)
+    llama_state = (ctypes.c_uint8 * int(state_size))()
+    n_bytes = llama_cpp.llama_copy_state_data(model.ctx, llama_state)
+    return {
+        "input_ids": model.input_ids[: model.n_tokens].copy(),
+        "n_tokens": model.n_tokens,
+        "llama_state": ctypes.string_at(llama_state, n_bytes),
+        "llama_state_size": n_bytes,
+        "seed": model._seed,
+    }
+
+
+def restore_state(model: Llama, entry: Dict) -> bool:
+    """Load a captured state into the model unless it already starts with those tokens.
+
+    Returns False if llama.cpp rejects the state. The model is then reset, so the prompt is
+    evaluated from the start as if nothing had been cached.
+    """
+    n_tokens = entry["n_tokens"]
+    if model.n_tokens >= n_tokens and np.array_equal(
+        model.input_ids[:n_tokens], entry["input_ids"]
+    ):
+        return True
+
+    input_ids = np.zeros(model.n_ctx(), dtype=np.intc)
+    input_ids[:n_tokens] = entry["input_ids"]
+    # load_state broadcasts the scores over the restored rows, one row of zeros is enough
+    scores = np.zeros((1, model.n_vocab()), dtype=np.single)
+    try:
+        model.load_state(
+            LlamaState(
+                input_ids=input_ids,
+                scores=scores,
+                n_tokens=n_tokens,
+                llama_state=entry["llama_state"],
+                llama_state_size=entry["llama_state_size"],
+                seed=entry["seed"],
+            )
+        )
+    except (RuntimeError, ValueError) as e:
+        print(f"Failed to restore a saved model state: {e}")
+        model.reset()
+        return False
+    return True
+
+
+class PrefixCache:
+    """KV states of evaluated prompt prefixes, kept in memory and on disk"""
+
+    def __init__(
+        self,
+        cache_dir: Path = config.prefix_cache_dir,
+        memory_capacity: int = 256 * 1024**2,
+        disk_capacity: int = 1024**3,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.memory_capacity = memory_capacity
+        self.disk_capacity = disk_capacity
+        self.memory: "OrderedDict[str, Dict]" = OrderedDict()
+
+    @staticmethod
+    def _key(model: Llama, prefix: str) -> str:
+        # The state of a context can only be restored into a context of the same size and
+        # KV cache layout
+        params = model.context_params
+        key = (
+            f"{model.model_path}\0{model.n_ctx()}\0{params.type_k}\0{params.type_v}\0"
+            f"{params.flash_attn}\0{prefix}"
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _entry_size(entry: Dict) -> int:
+        return entry["llama_state_size"] + entry["input_ids"].nbytes
+
+    @property
+    def memory_size(self) -> int:
+        return sum(self._entry_size(entry) for entry in self.memory.values())
+
+    def get(self, model: Llama, prefix: str) -> Optional[Dict]:
+        key = self._key(model, prefix)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        path = self.cache_dir / f"{key}.state"
+        if not path.exists():
+            return None
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except Exception as e:
+            print(f"Failed to read prefix cache entry {path}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)  # Disk eviction is ordered by last use
+        self._put_memory(key, entry)
+        return entry
+
+    def put(self, model: Llama, prefix: str, entry: Dict):
+        key = self._key(model, prefix)
+        self._put_memory(key, entry)
+
+        path = self.cache_dir / f"{key}.state"
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, path)
+        self._evict_disk()
+
+    def discard(self, model: Llama, prefix: str):
+        key = self._key(model, prefix)
+        self.memory.pop(key, None)
+        (self.cache_dir / f"{key}.state").unlink(missing_ok=True)
+
+    def clear_memory(self):
+        self.memory.clear()
+
+    def _put_memory(self, key: str, entry: Dict):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > 1 and self.memory_size > self.memory_capacity:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        files = sorted(self.cache_dir.glob("*.state"), key=lambda p: p.stat().st_mtime)
+        total_size = sum(p.stat().st_size for p in files)
+        while files and total_size > self.disk_capacity:
+            oldest = files.pop(0)
+            total_size -= oldest.stat().st_size
+            oldest.unlink(missing_ok=True)
@@ -1,29 +1,176 @@
+import threading
+import time
+from typing import Dict, List, Tuple
+
 from PyQt5.QtCore import (
     QThread,
     pyqtSignal,
 )
-from llama_assistant.model_handler import handler as model_handler
+from llama_assistant.inference_worker import InferenceWorker
+
+
+class TokenBuffer:
+    """Text streamed since the UI last drew, so that it is inserted once per frame"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chunks: Dict[int, List[str]] = {}
+
+    def append(self, request_id: int, text: str):
+        with self.lock:
+            self.chunks.setdefault(request_id, []).append(text)
+
+    def take(self) -> List[Tuple[int, str]]:
+        with self.lock:
+            chunks, self.chunks = self.chunks, {}
+        return [(request_id, "".join(texts)) for request_id, texts in chunks.items()]
 
 
 class ProcessingThread(QThread):
-    update_signal = pyqtSignal(str)
-    finished_signal = pyqtSignal()
+    """Client of the inference worker process that runs all requests against the models.
+
+    Generation happens in a separate process, so llama.cpp neither competes with the UI
+    for the GIL nor takes the app down when it crashes; a dead worker is restarted.
+    A new request cancels the running generation at the next token and drops the
+    requests that are still queued in the worker.
+    """
+
+    finished_signal = pyqtSignal(int)
+    cancelled_signal = pyqtSignal(int)
+    model_ready_signal = pyqtSignal(str)
+    error_signal = pyqtSignal(str)
 
-    def __init__(self, model, prompt, image=None):
+    def __init__(self):
         super().__init__()
-        self.model = model
-        self.prompt = prompt
-        self.image = image
+        self.worker = InferenceWorker()
+        # Read by the UI on a timer instead of a signal per token
+        self.tokens = TokenBuffer()
+        self.next_request_id = 0
+        self.active_requests = set()
+        self.settings = None
+        self.preloaded_model = None
+        # Requests submitted while the worker restarts, sent once it is back
+        self.unsent_requests = []
+        self.lock = threading.Lock()
+        self.running = True
+        # Started right away so that nothing sent before the thread runs is lost
+        self._start_worker()
+
+    def submit(self, model, prompt, image=None, prefix=None, session=None, task=None, preempt=True):
+        with self.lock:
+            if preempt:
+                self._cancel_all()
+            self.next_request_id += 1
+            request_id = self.next_request_id
+            self.active_requests.add(request_id)
+            command = (
+                "generate",
+                request_id,
+                model,
+                {
+                    "prompt": prompt,
+                    "image": image,
+                    "prefix": prefix,
+                    "session_id": session.session_id if session is not None else None,
+                    "task": task,
+                },
+            )
+            if not self.worker.send(*command):
+                self.unsent_requests.append(command)
+        return request_id
+
+    def preload(self, model):
+        """Load and warm up a model unless a newer request arrives first"""
+        with self.lock:
+            self.preloaded_model = model
+            self.next_request_id += 1
+            self.worker.send("warm_up", self.next_request_id, model)
+
+    def apply_settings(self, settings):
+        with self.lock:
+            self.settings = settings
+            self.worker.send("settings", settings)
+
+    def cancel(self):
+        with self.lock:
+            self._cancel_all()
+
+    def take_tokens(self) -> List[Tuple[int, str]]:
+        return self.tokens.take()
+
+    def is_busy(self):
+        return bool(self.active_requests)
+
+    def stop(self):
+        self.running = False
+        self.wait()
+
+    def _cancel_all(self):
+        self.active_requests.clear()
+        self.unsent_requests.clear()
+        self.worker.send("cancel")
+
+    def _start_worker(self):
+        with self.lock:
+            self.worker.start()
+            if self.worker.is_attached_to_daemon():
+                print("Attached to the llama-assistant daemon")
+            if self.settings is not None:
+                self.worker.send("settings", self.settings)
+            if self.preloaded_model is not None:
+                self.worker.send("warm_up", 0, self.preloaded_model)
+            unsent_requests, self.unsent_requests = self.unsent_requests, []
+            for command in unsent_requests:
+                if not self.worker.send(*command):
+                    self.unsent_requests.append(command)
 
     def run(self):
-        output = model_handler.chat_completion(
-            self.model, self.prompt, image=self.image, stream=True
-        )
-        for chunk in output:
-            delta = chunk["choices"][0]["delta"]
-            if "role" in delta:
-                print(delta["role"], end=": ")
-            elif "content" in delta:
-                print(delta["content"], end="")
-                self.update_signal.emit(delta["content"])
-        self.finished_signal.emit()
+        restart_delay = 1
+        started = time.monotonic()
+        while self.running:
+            event = self.worker.poll(0.01)
+            self.buffer_tokens()
+            if event is not None:
+                self.process_event(event)
+            elif not self.worker.is_alive():
+                self.on_worker_died()
+                # Back off when the worker crashes right away, e.g. on every model load
+                if time.monotonic() - started < 60:
+                    time.sleep(restart_delay)
+                    restart_delay = min(restart_delay * 2, 30)
+                else:
+                    restart_delay = 1
+                self._start_worker()
+                started = time.monotonic()
+        self.worker.close()
+
+    def buffer_tokens(self):
+        records = self.worker.read_tokens()
+        for request_id, text in records:
+            self.tokens.append(request_id, text)
+
+    def process_event(self, event):
+        kind, *args = event
+        if kind == "finished":
+            self.active_requests.discard(args[0])
+            self.finished_signal.emit(args[0])
+        elif kind == "cancelled":
+            self.active_requests.discard(args[0])
+            self.cancelled_signal.emit(args[0])
+        elif kind == "model_ready":
+            self.model_ready_signal.emit(args[0])
+        elif kind == "error":
+            self.error_signal.emit(args[0])
+
+    def on_worker_died(self):
+        print(f"Inference worker exited with code {self.worker.get_exit_code()}, restarting")
+        self.buffer_tokens()
+        self.worker.stop()
+        self.error_signal.emit("The inference worker stopped unexpectedly")
+        with self.lock:
+            request_ids = list(self.active_requests)
+            self.active_requests.clear()
+            # They are reported as finished below, the new worker must not run them
+            self.unsent_requests.clear()
+        for request_id in request_ids:
+            self.finished_signal.emit(request_id)
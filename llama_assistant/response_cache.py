@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from llama_assistant import config
+
+_fingerprints: Dict = {}
+
+
+def file_fingerprint(path: str) -> str:
+    """Hash of a model file's size and its first and last MiB.
+
+    Hashing the whole multi-GB file on every request would cost more than the cache
+    saves, and GGUF files that differ always differ in their header or tail.
+    """
+    stat = os.stat(path)
+    cache_key = (path, stat.st_size, stat.st_mtime)
+    if cache_key not in _fingerprints:
+        digest = hashlib.sha256(str(stat.st_size).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read(1024**2))
+            f.seek(max(stat.st_size - 1024**2, 0))
+            digest.update(f.read(1024**2))
+        _fingerprints[cache_key] = digest.hexdigest()
+    return _fingerprints[cache_key]
+
+
+class ResponseCache:
+    """Exact-match cache of generated responses with an in-memory LRU and a SQLite store"""
+
+    def __init__(
+        self,
+        db_path: Path = config.response_cache_file,
+        memory_entries: int = 256,
+        max_entries: int = 10000,
+        ttl: float = 30 * 24 * 3600,
+    ):
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.db.commit()
+
+    @staticmethod
+    def make_key(
+        model_hash: str,
+        task: Optional[str],
+        prompt: str,
+        image_hash: Optional[str],
+        sampling_params: Dict,
+    ) -> str:
+        key = json.dumps([model_hash, task, prompt, image_hash, sampling_params], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            now = time.time()
+            if key in self.memory and self.memory[key][1] > now - self.ttl:
+                self.memory.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.memory[key][0]
+
+            row = self.db.execute(
+                "SELECT response, created FROM responses WHERE key = ? AND created > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.db.commit()
+            self._put_memory(key, row[0], row[1])
+            self.stats["hits"] += 1
+            return row[0]
+
+    def put(self, key: str, response: str):
+        with self.lock:
+            now = time.time()
+            self._put_memory(key, response, now)
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            self._evict(now)
+            self.db.commit()
+
+    def clear_memory(self):
+        with self.lock:
+            self.memory.clear()
+
+    def _put_memory(self, key: str, response: str, created: float):
+        self.memory[key] = (response, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict(self, now: float):
+        self.db.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+        self.db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
@@ -0,0 +1,179 @@
+import json
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from llama_assistant import config
+
+
+class SemanticCache:
+    """Cache of responses looked up by the cosine similarity of prompt embeddings.
+
+    Normalized embeddings are kept in a memory-mapped float32 matrix, so a lookup is a
+    single matrix-vector product over all cached prompts. Once max_entries is reached
+    the oldest slots are overwritten.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = config.semantic_cache_dir,
+        threshold: float = 0.92,
+        max_entries: int = 50000,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.vectors_file = self.cache_dir / "vectors.f32"
+        self.entries_file = self.cache_dir / "entries.jsonl"
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.stats = {"lookups": 0, "hits": 0}
+        # Best similarity of recent lookups, to see where the threshold should be
+        self.recent_similarities = deque(maxlen=1000)
+
+        self.dim = 0
+        self.count = 0
+        self.next_slot = 0
+        self.entries: List[Dict] = []
+        self.vectors: Optional[np.memmap] = None
+        self.model_codes = np.zeros(0, dtype=np.int32)
+        self.model_keys: Dict[str, int] = {}
+        self._load()
+
+    def _load(self):
+        if not self.entries_file.exists():
+            return
+        entries = {}
+        n_lines = 0
+        with open(self.entries_file, "r") as f:
+            for line in f:
+                n_lines += 1
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Partially written last line
+                self.dim = entry["dim"]
+                entries[entry["slot"]] = entry
+                self.count = max(self.count, entry["slot"] + 1)
+                self.next_slot = (entry["slot"] + 1) % self.max_entries
+        if not entries or not self.vectors_file.exists():
+            return
+        n_rows = self.vectors_file.stat().st_size // (4 * self.dim)
+        if n_rows == 0:
+            return
+        self.count = min(self.count, n_rows)
+        self.vectors = np.memmap(self.vectors_file, dtype=np.float32, mode="r+")
+        self.vectors = self.vectors.reshape(n_rows, self.dim)
+        self.entries = [entries.get(slot, {}) for slot in range(self.count)]
+        self.model_codes = np.array(
+            [self._model_code(e.get("model_key")) for e in self.entries], dtype=np.int32
+        )
+        if n_lines > 2 * len(entries):
+            # Drop the lines of overwritten slots
+            with open(self.entries_file, "w") as f:
+                for entry in entries.values():
+                    f.write(json.dumps(entry) + "\n")
+
+    def _model_code(self, model_key: Optional[str]) -> int:
+        if model_key is None:
+            return -1
+        return self.model_keys.setdefault(model_key, len(self.model_keys))
+
+    def _ensure_capacity(self, rows: int):
+        capacity = 0 if self.vectors is None else self.vectors.shape[0]
+        if rows <= capacity:
+            return
+        new_capacity = min(max(capacity * 2, 1024), self.max_entries)
+        if self.vectors is not None:
+            self.vectors.flush()
+        with open(self.vectors_file, "ab") as f:
+            f.truncate(new_capacity * self.dim * 4)
+        self.vectors = np.memmap(
+            self.vectors_file, dtype=np.float32, mode="r+", shape=(new_capacity, self.dim)
+        )
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        if vector.ndim == 2:
+            # Models without pooling return one embedding per token
+            vector = vector.mean(axis=0)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding, model_key: str) -> Optional[Tuple[str, float]]:
+        """Cached response of the most similar prompt for the same model, if close enough"""
+        query = self._normalize(embedding)
+        with self.lock:
+            self.stats["lookups"] += 1
+            if self.count == 0 or query.shape[0] != self.dim:
+                self.recent_similarities.append(0.0)
+                return None
+
+            similarities = self.vectors[: self.count] @ query
+            similarities[self.model_codes[: self.count] != self._model_code(model_key)] = -1
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            self.recent_similarities.append(similarity)
+            if similarity < self.threshold:
+                return None
+            self.stats["hits"] += 1
+            return self.entries[best]["response"], similarity
+
+    def add(self, embedding, model_key: str, prompt: str, response: str):
+        vector = self._normalize(embedding)
+        with self.lock:
+            if self.dim != vector.shape[0]:
+                if self.count:
+                    print("Embedding size changed, clearing the semantic cache")
+                self._reset(vector.shape[0])
+
+            slot = self.next_slot
+            self.next_slot = (slot + 1) % self.max_entries
+            self._ensure_capacity(slot + 1)
+            self.vectors[slot] = vector
+            entry = {
+                "slot": slot,
+                "dim": self.dim,
+                "model_key": model_key,
+                "prompt": prompt,
+                "response": response,
+            }
+            if slot < len(self.entries):
+                self.entries[slot] = entry
+                self.model_codes[slot] = self._model_code(model_key)
+            else:
+                self.entries.append(entry)
+                self.model_codes = np.append(self.model_codes, self._model_code(model_key))
+            self.count = max(self.count, slot + 1)
+            with open(self.entries_file, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def _reset(self, dim: int):
+        self.dim = dim
+        self.count = 0
+        self.next_slot = 0
+        self.entries = []
+        self.vectors = None
+        self.model_codes = np.zeros(0, dtype=np.int32)
+        self.vectors_file.unlink(missing_ok=True)
+        self.entries_file.unlink(missing_ok=True)
+
+    def get_stats(self) -> Dict:
+        # Also called from other threads than the lookups, e.g. the model reaper
+        with self.lock:
+            similarities = np.array(self.recent_similarities)
+        stats = {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / self.stats["lookups"] if self.stats["lookups"] else 0,
+            "entries": self.count,
+            "threshold": self.threshold,
+        }
+        if len(similarities):
+            stats["similarity_percentiles"] = {
+                p: float(np.percentile(similarities, p)) for p in (50, 75, 90, 95, 99)
+            }
+        return stats
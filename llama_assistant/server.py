@@ -0,0 +1,322 @@
+import argparse
+import json
+import threading
+import time
+import traceback
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+from llama_assistant import config
+from llama_assistant.model_registry import registry
+
+# Options of /v1/chat/completions that are passed on to llama.cpp
+CHAT_PARAMS = {
+    "max_tokens",
+    "temperature",
+    "top_p",
+    "top_k",
+    "min_p",
+    "stop",
+    "seed",
+    "presence_penalty",
+    "frequency_penalty",
+    "repeat_penalty",
+    "logit_bias",
+    "response_format",
+    "tools",
+    "tool_choice",
+}
+
+
+class APIError(Exception):
+    def __init__(self, status: int, message: str, error_type: str = "invalid_request_error"):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.error_type = error_type
+
+
+class RequestScheduler:
+    """Limits how many requests run at once and how many may wait for a turn.
+
+    The model's own llama.cpp context runs one sequence at a time, so exclusive requests
+    for the same model wait for each other. Requests that the batching engine takes
+    share the model, and requests for different models overlap up to the concurrency
+    limit.
+    """
+
+    def __init__(self, concurrency: int, max_queue: int, queue_timeout: float):
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.lock = threading.Lock()
+        self.model_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+
+    def acquire(self, model_id: str, exclusive: bool = True):
+        """Wait for a turn, exclusive requests also wait for other requests to the model"""
+        with self.lock:
+            if self.waiting >= self.max_queue:
+                raise APIError(503, "Too many queued requests", "server_busy")
+            self.waiting += 1
+            model_lock = self.model_locks[model_id]
+        try:
+            deadline = time.monotonic() + self.queue_timeout
+            if not self.slots.acquire(timeout=self.queue_timeout):
+                raise APIError(503, "Timed out waiting for a free slot", "server_busy")
+            if exclusive and not model_lock.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                self.slots.release()
+                raise APIError(503, "Timed out waiting for the model", "server_busy")
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def release(self, model_id: str, exclusive: bool = True):
+        if exclusive:
+            self.model_locks[model_id].release()
+        self.slots.release()
+
+
+class APIRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1 and a length or chunked encoding on every response
+    protocol_version = "HTTP/1.1"
+    server_version = "llama-assistant"
+    # Close idle keep-alive connections
+    timeout = 120
+
+    def do_GET(self):
+        self.dispatch({"/v1/models": self.list_models})
+
+    def do_POST(self):
+        self.dispatch(
+            {
+                "/v1/chat/completions": self.chat_completions,
+                "/v1/embeddings": self.embeddings,
+            }
+        )
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_cors_headers()
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def dispatch(self, routes: Dict):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        route = routes.get(path)
+        self.body = b""
+        try:
+            # Read the body even when the request fails, the next request on this
+            # connection starts after it
+            self.body = self.rfile.read(self.read_content_length())
+            if route is None:
+                raise APIError(404, f"Unknown endpoint: {self.command} {path}")
+            self.check_api_key()
+            route()
+        except APIError as e:
+            self.send_json({"error": {"message": e.message, "type": e.error_type}}, status=e.status)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json({"error": {"message": str(e), "type": "server_error"}}, status=500)
+
+    def read_content_length(self) -> int:
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Without the length of the body the next request can not be found either
+            self.close_connection = True
+            raise APIError(400, "Invalid Content-Length header")
+        return length
+
+    def check_api_key(self):
+        api_key = self.server.api_key
+        if api_key and self.headers.get("Authorization") != f"Bearer {api_key}":
+            raise APIError(401, "Invalid API key", "authentication_error")
+
+    def read_json(self) -> Dict:
+        try:
+            body = json.loads(self.body or b"{}")
+        except json.JSONDecodeError as e:
+            raise APIError(400, f"Invalid JSON body: {e}")
+        if not isinstance(body, dict):
+            raise APIError(400, "The request body must be a JSON object")
+        return body
+
+    def send_cors_headers(self):
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Headers", "Authorization, Content-Type")
+
+    def send_json(self, data: Dict, status: int = 200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_cors_headers()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def get_model_id(self, body: Dict, model_type: str, default: str) -> str:
+        model_id = body.get("model") or default
+        model = registry.get(model_id)
+        if model is None:
+            raise APIError(404, f"The model '{model_id}' does not exist", "model_not_found")
+        if (model_type == "embedding") != (model.model_type == "embedding"):
+            raise APIError(400, f"The model '{model_id}' does not support {self.path}")
+        return model_id
+
+    def list_models(self):
+        self.send_json(
+            {
+                "object": "list",
+                "data": [
+                    {
+                        "id": model.model_id,
+                        "object": "model",
+                        "created": 0,
+                        "owned_by": "llama-assistant",
+                    }
+                    for model in registry.list()
+                ],
+            }
+        )
+
+    def chat_completions(self):
+        body = self.read_json()
+        messages = body.get("messages")
+        if not isinstance(messages, list) or not messages:
+            raise APIError(400, "'messages' must be a non-empty list")
+        model_id = self.get_model_id(body, "text", self.server.settings["text_model"])
+        params = {key: value for key, value in body.items() if key in CHAT_PARAMS}
+        stream = bool(body.get("stream"))
+
+        # Requests that the batching engine can take run next to each other
+        model_handler = self.server.model_handler
+        exclusive = not model_handler.can_batch(model_id, messages, params)
+        scheduler = self.server.scheduler
+        scheduler.acquire(model_id, exclusive)
+        try:
+            response = model_handler.create_chat_completion(
+                model_id, messages, stream=stream, **params
+            )
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            if stream:
+                self.stream_chat_completion(response, model_id, completion_id)
+            else:
+                self.send_json(complete_fields(response, model_id, completion_id))
+        finally:
+            scheduler.release(model_id, exclusive)
+
+    def stream_chat_completion(self, response, model_id: str, completion_id: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_cors_headers()
+        self.end_headers()
+        try:
+            for chunk in response:
+                chunk = complete_fields(chunk, model_id, completion_id, "chat.completion.chunk")
+                self.send_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.send_chunk(b"data: [DONE]\n\n")
+            self.send_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away, stop generating
+            response.close()
+            self.close_connection = True
+        except Exception as e:
+            # The status line is already sent, report the error as the last event
+            traceback.print_exc()
+            error = {"error": {"message": str(e), "type": "server_error"}}
+            self.send_chunk(f"data: {json.dumps(error)}\n\n".encode("utf-8"))
+            self.send_chunk(b"")
+
+    def embeddings(self):
+        body = self.read_json()
+        text = body.get("input")
+        if not isinstance(text, (str, list)) or not text:
+            raise APIError(400, "'input' must be a string or a list of strings")
+        model_id = self.get_model_id(
+            body, "embedding", self.server.model_handler.embedding_model_id
+        )
+
+        scheduler = self.server.scheduler
+        scheduler.acquire(model_id)
+        try:
+            self.send_json(self.server.model_handler.create_embedding(text, model_id))
+        finally:
+            scheduler.release(model_id)
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} - {format % args}")
+
+
+def complete_fields(
+    response: Dict, model_id: str, completion_id: str, object_type: str = "chat.completion"
+) -> Dict:
+    """Fill in the fields that responses replayed from the cache do not have"""
+    response.setdefault("id", completion_id)
+    response.setdefault("object", object_type)
+    response.setdefault("created", int(time.time()))
+    response.setdefault("model", model_id)
+    return response
+
+
+class APIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, scheduler: RequestScheduler, api_key: Optional[str] = None):
+        from llama_assistant.model_handler import handler as model_handler
+
+        super().__init__(address, APIRequestHandler)
+        self.model_handler = model_handler
+        self.scheduler = scheduler
+        self.api_key = api_key
+        self.settings = config.load_settings()
+        model_handler.apply_settings(self.settings)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="llama-assistant serve",
+        description="Serve the configured models over an OpenAI-compatible HTTP API",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--concurrency", type=int, help="Requests that run at once (default: 2 or --parallel)"
+    )
+    parser.add_argument("--max-queue", type=int, default=16, help="Requests that may wait")
+    parser.add_argument(
+        "--queue-timeout", type=float, default=300, help="Seconds a request may wait"
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        help="Sequences decoded together per model (default: batching_slots setting)",
+    )
+    parser.add_argument("--api-key", help="Require this bearer token")
+    args = parser.parse_args(argv)
+
+    parallel = args.parallel or config.load_settings()["batching_slots"]
+    concurrency = args.concurrency or max(2, parallel)
+    scheduler = RequestScheduler(concurrency, args.max_queue, args.queue_timeout)
+    server = APIServer((args.host, args.port), scheduler, api_key=args.api_key)
+    server.model_handler.batching_slots = parallel
+    print(f"Serving the OpenAI-compatible API on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
@@ -22,15 +22,17 @@ from pynput import keyboard
 
 from llama_assistant.shortcut_recorder import ShortcutRecorder
 from llama_assistant import config
+from llama_assistant.model_registry import registry
 
 
 class SettingsDialog(QDialog):
     settingsSaved = pyqtSignal()
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, model_registry_watcher=None):
         super().__init__(parent)
         self.setWindowTitle("Settings")
         self.main_layout = QVBoxLayout(self)
+        self.model_registry_watcher = model_registry_watcher
 
         # General Settings Group
         self.create_general_settings_group()
@@ -56,6 +58,18 @@ class SettingsDialog(QDialog):
 
         self.load_settings()
 
+        # Follow edits of custom_models.json made while the dialog is open
+        if self.model_registry_watcher is not None:
+            self.model_registry_watcher.models_changed.connect(self.on_models_changed)
+
+    def done(self, result):
+        if self.model_registry_watcher is not None:
+            self.model_registry_watcher.models_changed.disconnect(self.on_models_changed)
+        super().done(result)
+
+    def on_models_changed(self, changes):
+        self.refresh_model_combos()
+
     def create_general_settings_group(self):
         group_box = QGroupBox("General Settings")
         layout = QVBoxLayout()
@@ -149,7 +163,7 @@ class SettingsDialog(QDialog):
         super().accept()
 
     def get_model_names_by_type(self, model_type):
-        return [model["model_id"] for model in config.models if model["model_type"] == model_type]
+        return [model.model_id for model in registry.list(model_type)]
 
     def choose_color(self):
         color = QColorDialog.getColor()
@@ -209,7 +223,7 @@ class SettingsDialog(QDialog):
             json.dump(settings, f)
 
     def open_custom_models_dialog(self):
-        dialog = CustomModelsDialog(self)
+        dialog = CustomModelsDialog(self, self.model_registry_watcher)
         if dialog.exec():
             # Refresh the model combos after managing custom models
             self.refresh_model_combos()
@@ -232,10 +246,11 @@ class SettingsDialog(QDialog):
 
 
 class CustomModelsDialog(QDialog):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, model_registry_watcher=None):
         super().__init__(parent)
         self.setWindowTitle("Manage Custom Models")
         self.layout = QVBoxLayout(self)
+        self.model_registry_watcher = model_registry_watcher
 
         self.model_list = QListWidget()
         self.model_list.itemSelectionChanged.connect(self.load_selected_model)
@@ -272,6 +287,17 @@ class CustomModelsDialog(QDialog):
 
         self.refresh_model_list()
 
+        if self.model_registry_watcher is not None:
+            self.model_registry_watcher.models_changed.connect(self.on_models_changed)
+
+    def done(self, result):
+        if self.model_registry_watcher is not None:
+            self.model_registry_watcher.models_changed.disconnect(self.on_models_changed)
+        super().done(result)
+
+    def on_models_changed(self, changes):
+        self.refresh_model_list()
+
     def refresh_model_list(self):
         self.model_list.clear()
         for model in config.custom_models:
@@ -308,8 +334,7 @@ class CustomModelsDialog(QDialog):
             "filename": filename,
         }
 
-        config.custom_models.append(new_model)
-        config.save_custom_models()
+        registry.save_custom_models(config.custom_models + [new_model])
         self.refresh_model_list()
         self.clear_inputs()
         QMessageBox.information(
@@ -341,10 +366,15 @@ class CustomModelsDialog(QDialog):
             "repo_id": repo_id,
             "filename": filename,
         }
-
-        config.custom_models[selected_index] = updated_model
-        config.models = config.DEFAULT_MODELS + config.custom_models
-        config.save_custom_models()
+        # The runtime profile and idle TTL can only be edited in custom_models.json, keep
+        # them on update
+        for key in ("runtime", "idle_ttl"):
+            if key in config.custom_models[selected_index]:
+                updated_model[key] = config.custom_models[selected_index][key]
+
+        custom_models = list(config.custom_models)
+        custom_models[selected_index] = updated_model
+        registry.save_custom_models(custom_models)
         self.refresh_model_list()
         self.clear_inputs()
         QMessageBox.information(
@@ -359,9 +389,9 @@ class CustomModelsDialog(QDialog):
 
         selected_index = self.model_list.row(selected_items[0])
         model_name = config.custom_models[selected_index]["model_name"]
-        del config.custom_models[selected_index]
-        config.models = config.DEFAULT_MODELS + config.custom_models
-        config.save_custom_models()
+        registry.save_custom_models(
+            config.custom_models[:selected_index] + config.custom_models[selected_index + 1 :]
+        )
         self.refresh_model_list()
         self.clear_inputs()
         QMessageBox.information(
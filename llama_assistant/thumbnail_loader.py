@@ -0,0 +1,100 @@
+import os
+from collections import OrderedDict
+from typing import Tuple
+
+from PyQt5.QtCore import QObject, QRectF, QRunnable, QSize, Qt, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader, QPainter, QPainterPath
+
+THUMBNAIL_SIZE = 80
+CORNER_RADIUS = 20
+
+
+def make_thumbnail(path: str, size: int = THUMBNAIL_SIZE) -> QImage:
+    """Decode an image at thumbnail size and round its corners, safe outside the GUI thread"""
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    source_size = reader.size()
+    if source_size.isValid():
+        # Decoders that support it, like JPEG, never build the full resolution image
+        reader.setScaledSize(
+            source_size.scaled(QSize(size, size), Qt.AspectRatioMode.KeepAspectRatio)
+        )
+    image = reader.read()
+    if image.isNull():
+        return image
+    if image.width() > size or image.height() > size:
+        image = image.scaled(
+            size,
+            size,
+            Qt.AspectRatioMode.KeepAspectRatio,
+            Qt.TransformationMode.SmoothTransformation,
+        )
+
+    thumbnail = QImage(image.size(), QImage.Format.Format_ARGB32_Premultiplied)
+    thumbnail.fill(Qt.GlobalColor.transparent)
+    corners = QPainterPath()
+    corners.addRoundedRect(QRectF(thumbnail.rect()), CORNER_RADIUS, CORNER_RADIUS)
+    painter = QPainter(thumbnail)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    painter.setClipPath(corners)
+    painter.drawImage(0, 0, image)
+    painter.end()
+    return thumbnail
+
+
+class ThumbnailSignals(QObject):
+    finished = pyqtSignal(str, float, QImage)
+
+
+class ThumbnailTask(QRunnable):
+    def __init__(self, path: str, mtime: float, signals: ThumbnailSignals):
+        super().__init__()
+        self.path = path
+        self.mtime = mtime
+        self.signals = signals
+
+    def run(self):
+        self.signals.finished.emit(self.path, self.mtime, make_thumbnail(self.path))
+
+
+class ThumbnailLoader(QObject):
+    """Makes thumbnails on a thread pool and caches them by file path and mtime.
+
+    thumbnail_ready is emitted in the GUI thread with an image that only needs to be
+    shown, a null image if the file could not be read.
+    """
+
+    thumbnail_ready = pyqtSignal(str, QImage)
+
+    def __init__(self, max_entries: int = 64, parent=None):
+        super().__init__(parent)
+        self.max_entries = max_entries
+        self.cache: "OrderedDict[Tuple[str, float], QImage]" = OrderedDict()
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(2)
+        self.signals = ThumbnailSignals(self)
+        # Queued to this object's thread, the GUI thread
+        self.signals.finished.connect(self.on_finished)
+
+    def request(self, path: str):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            self.thumbnail_ready.emit(path, QImage())
+            return
+        key = (path, mtime)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.thumbnail_ready.emit(path, self.cache[key])
+            return
+        self.pool.start(ThumbnailTask(path, mtime, self.signals))
+
+    def on_finished(self, path: str, mtime: float, thumbnail: QImage):
+        if not thumbnail.isNull():
+            self.cache[(path, mtime)] = thumbnail
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        self.thumbnail_ready.emit(path, thumbnail)
+
+    def wait(self):
+        self.pool.waitForDone()
@@ -2,6 +2,7 @@ from PyQt5.QtWidgets import (
     QWidget,
     QVBoxLayout,
     QHBoxLayout,
+    QLabel,
     QTextBrowser,
     QPushButton,
     QScrollArea,
@@ -123,6 +124,11 @@ class UIManager:
             button.clicked.connect(self.parent.on_task_button_clicked)
             button_layout.addWidget(button)
 
+        button_layout.addStretch()
+        self.model_status_label = QLabel("", self.parent)
+        self.model_status_label.setStyleSheet("color: #aaa; font-size: 12px;")
+        button_layout.addWidget(self.model_status_label)
+
         top_layout.addLayout(button_layout)
         main_layout.addLayout(top_layout)
 
@@ -198,7 +204,7 @@ class UIManager:
         main_layout.addWidget(self.scroll_area)
 
         self.parent.esc_shortcut = QShortcut(QKeySequence("Esc"), self.parent)
-        self.parent.esc_shortcut.activated.connect(self.parent.hide)
+        self.parent.esc_shortcut.activated.connect(self.parent.on_escape)
 
         # Add an expanding spacer
         spacer = QSpacerItem(20, 40, QSizePolicy.Minimum, QSizePolicy.Expanding)
@@ -3,14 +3,15 @@ import os
 import sys
 from importlib import resources
 
-from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt
+from llama_assistant.image_preprocessor import detect_image_format
 
 
 def image_to_base64_data_uri(file_path):
     with open(file_path, "rb") as img_file:
-        base64_data = base64.b64encode(img_file.read()).decode("utf-8")
-        return f"data:image/png;base64,{base64_data}"
+        image_bytes = img_file.read()
+    mime_type = detect_image_format(image_bytes[:16]) or "image/png"
+    base64_data = base64.b64encode(image_bytes).decode("utf-8")
+    return f"data:{mime_type};base64,{base64_data}"
 
 
 def get_resource_path(relative_path):
@@ -35,6 +36,10 @@ def get_resource_path(relative_path):
 
 def load_image(relative_path, size=None):
     """Load an image from a relative path and optionally resize it"""
+    # Imported here so that the headless commands can use this module without PyQt5
+    from PyQt5.QtGui import QPixmap
+    from PyQt5.QtCore import Qt
+
     full_path = get_resource_path(relative_path)
     if os.path.exists(full_path):
         pixmap = QPixmap(full_path)
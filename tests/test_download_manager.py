@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from llama_assistant import download_manager
+from llama_assistant.download_manager import DownloadError, DownloadManager
+from llama_assistant.model_registry import Model
+
+REPO_ID = "test-org/test-model-GGUF"
+MODEL_DATA = os.urandom(3 * 1024**2 + 123)
+CLIP_DATA = os.urandom(512 * 1024)
+
+
+class Hub:
+    """Local stand-in for the two Hub endpoints the download manager uses"""
+
+    def __init__(self):
+        self.files = {
+            "test-model-q4_k_m.gguf": MODEL_DATA,
+            "mmproj-test-f16.gguf": CLIP_DATA,
+            "README.md": b"test",
+            "Q8_0/test-model-q8_0.gguf": os.urandom(1024),
+        }
+        self.checksums = {
+            name: hashlib.sha256(data).hexdigest() for name, data in self.files.items()
+        }
+        self.chunk_delay = 0.0
+        self.bytes_served = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.endpoint = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def make_handler(self):
+        hub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                if url.path == f"/api/models/{REPO_ID}/tree/main":
+                    self.send_tree(urllib.parse.parse_qs(url.query))
+                else:
+                    self.send_file(urllib.parse.unquote(url.path.split("/resolve/main/", 1)[1]))
+
+            def send_tree(self, query):
+                tree = []
+                for name, data in hub.files.items():
+                    if "/" in name:
+                        if "recursive" not in query:
+                            continue
+                        tree.append({"type": "directory", "path": name.split("/")[0]})
+                    entry = {"type": "file", "path": name, "size": len(data)}
+                    if name.endswith(".gguf"):
+                        entry["lfs"] = {"oid": hub.checksums[name], "size": len(data)}
+                    tree.append(entry)
+                # Two entries per page, like the Hub pages long listings
+                cursor = int(query.get("cursor", ["0"])[0])
+                body = json.dumps(tree[cursor : cursor + 2]).encode()
+                self.send_response(200)
+                if cursor + 2 < len(tree):
+                    next_page = f"{hub.endpoint}{self.path.split('&')[0]}&cursor={cursor + 2}"
+                    self.send_header("Link", f'<{next_page}>; rel="next"')
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_file(self, name: str):
+                data = hub.files[name]
+                start, end = 0, len(data) - 1
+                range_match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+                if range_match:
+                    start, end = int(range_match.group(1)), int(range_match.group(2))
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                try:
+                    for offset in range(start, end + 1, 64 * 1024):
+                        chunk = data[offset : min(offset + 64 * 1024, end + 1)]
+                        self.wfile.write(chunk)
+                        with hub.lock:
+                            hub.bytes_served += len(chunk)
+                        time.sleep(hub.chunk_delay)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def hub():
+    hub = Hub()
+    yield hub
+    hub.close()
+
+
+@pytest.fixture(autouse=True)
+def no_hf_cache(monkeypatch):
+    # Files in the real Hugging Face cache of the machine must not be picked up
+    monkeypatch.setattr(download_manager, "find_in_hf_cache", lambda *args: None)
+
+
+def make_manager(models_dir, endpoint):
+    return DownloadManager(
+        models_dir=models_dir,
+        endpoint=endpoint,
+        segments=4,
+        min_segment_size=256 * 1024,
+        chunk_size=64 * 1024,
+        timeout=5,
+        retries=0,
+    )
+
+
+def read_bytes(path) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_downloads_model_and_mmproj(hub, tmp_path):
+    manager = make_manager(tmp_path, hub.endpoint)
+    files = manager.ensure("test/image", REPO_ID, "*q4_k_m.gguf", "image")
+
+    assert read_bytes(files["model_path"]) == MODEL_DATA
+    assert read_bytes(files["clip_model_path"]) == CLIP_DATA
+    assert not list(tmp_path.rglob("*.part*"))
+    assert manager.get_local_files("test/image", REPO_ID, "*q4_k_m.gguf") == files
+
+
+def test_finds_files_in_subfolders(hub, tmp_path):
+    files = make_manager(tmp_path, hub.endpoint).ensure("test/q8", REPO_ID, "*q8_0.gguf", "text")
+    assert read_bytes(files["model_path"]) == hub.files["Q8_0/test-model-q8_0.gguf"]
+
+
+def test_resumes_interrupted_download(hub, tmp_path):
+    hub.chunk_delay = 0.01
+    manager = make_manager(tmp_path, hub.endpoint)
+
+    def cancel_halfway(phase, done, total):
+        if done >= total // 2:
+            manager.cancel()
+
+    with pytest.raises(DownloadError):
+        manager.ensure("test/text", REPO_ID, "*q4_k_m.gguf", "text", cancel_halfway)
+    assert list(tmp_path.rglob("*.gguf.part"))
+    served_before_resume = hub.bytes_served
+
+    hub.chunk_delay = 0.0
+    files = make_manager(tmp_path, hub.endpoint).ensure(
+        "test/text", REPO_ID, "*q4_k_m.gguf", "text"
+    )
+    assert read_bytes(files["model_path"]) == MODEL_DATA
+    # Only the rest of the file is fetched again
+    assert hub.bytes_served - served_before_resume < len(MODEL_DATA) * 3 // 4
+
+
+def test_rejects_checksum_mismatch(hub, tmp_path):
+    hub.checksums["test-model-q4_k_m.gguf"] = hashlib.sha256(b"other content").hexdigest()
+    manager = make_manager(tmp_path, hub.endpoint)
+
+    with pytest.raises(DownloadError, match="Checksum mismatch"):
+        manager.ensure("test/text", REPO_ID, "*q4_k_m.gguf", "text")
+    assert not list(tmp_path.rglob("*.gguf"))
+    assert not list(tmp_path.rglob("*.part*"))
+    assert manager.get_local_files("test/text", REPO_ID, "*q4_k_m.gguf") is None
+
+
+def test_reuses_downloaded_files_offline(hub, tmp_path):
+    files = make_manager(tmp_path, hub.endpoint).ensure(
+        "test/text", REPO_ID, "*q4_k_m.gguf", "text"
+    )
+    hub.close()
+
+    offline = make_manager(tmp_path, hub.endpoint)
+    assert offline.ensure("test/text", REPO_ID, "*q4_k_m.gguf", "text") == files
+    # A model changed to another file is not answered from the index
+    with pytest.raises(DownloadError):
+        offline.ensure("test/text", REPO_ID, "*q8_0.gguf", "text")
+
+
+def test_download_thread_survives_unexpected_errors(tmp_path):
+    from llama_assistant.download_thread import DownloadThread
+
+    models = [
+        Model("text", f"test/{name}", name, repo_id=REPO_ID, filename=f"*{name}.gguf")
+        for name in ("broken", "working")
+    ]
+    thread = DownloadThread(models[:1])
+    errors, finished = [], []
+    thread.error_signal.connect(lambda model_id, message: errors.append(model_id))
+    thread.finished_signal.connect(finished.append)
+
+    def ensure(model_id, *args):
+        if model_id == "test/broken":
+            assert thread.add_models(models[1:])  # Queued to the running thread
+            raise RuntimeError("unexpected")
+
+    thread.manager.ensure = ensure
+    thread.run()
+
+    assert errors == ["test/broken"]
+    assert finished == ["test/working"]
+    assert not thread.add_models(models)  # Finished, a new thread is needed